@@ -0,0 +1,377 @@
+"""Нагрузочный тест: учебная группа из 50–500 активных участников.
+
+Гоняет настоящие обработчики бота (letsgo, log_message, check_user_translation, user_stats, done)
+синтетическими Update. Каждый участник проходит свой сценарий по порядку, а все участники —
+одновременно (с разгоном --ramp-seconds). Внешние сервисы подменяются:
+  - OpenAI — локальная заглушка (aiohttp) с настраиваемой задержкой, бот ходит в неё через OPENAI_BASE_URL;
+  - Telegram — подкласс Bot, который ничего не отправляет, а только считает сообщения.
+
+Отчёт: p50/p95/p99/max по каждому обработчику, пропускная способность (обработчиков и проверенных
+переводов в секунду), пик соединений с базой (pg_stat_activity) и пика ожидания в пуле бота.
+
+Базовая линия хранится в JSON (по умолчанию benchmarks/load_baseline.json, ключ — параметры прогона).
+Она зависит от машины, поэтому в репозиторий не коммитится: сохраните её у себя до изменений
+(--save-baseline), потом запускайте тест после изменений — при регрессии p95/p99 или пропускной
+способности больше --tolerance скрипт завершится с кодом 1.
+
+Нужна отдельная база (таблицы бота создаются миграциями, данные тестовых пользователей удаляются
+перед прогоном):
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/load_test.py [--users 50] [--openai-latency-ms 800]
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/load_test.py --users 200 --save-baseline
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+from aiohttp import web
+
+BENCH_USER_ID_BASE = 900_000_000  # Тестовые user_id: BENCH_USER_ID_BASE + номер участника
+BENCH_CHAT_ID = -100_900_000_000
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "load_baseline.json")
+MIN_REGRESSION_MS = 5  # Разница меньше этого не считается регрессией (шум таймера и планировщика)
+
+
+# === Заглушка OpenAI ===
+def start_openai_stub(latency_ms, jitter_ms):
+    stats = {"requests": 0}
+
+    async def chat_completions(request):
+        stats["requests"] += 1
+        body = await request.json()
+        prompt = body["messages"][-1]["content"]
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+        grading = {"score": random.randint(50, 100), "errors": "",
+                   "correct_translation": "Das ist eine Übersetzung.", "synonym": "machen/tun"}
+        batch = re.search(r"\((\d+) шт\.\)", prompt)
+        if batch:
+            count = int(batch.group(1))
+            content = json.dumps({"results": [
+                {"index": i, **grading, "score": random.randint(50, 100)} for i in range(1, count + 1)
+            ]})
+        elif "генератор русских предложений" in prompt:
+            content = "\n".join(f"Синтетическое предложение {random.getrandbits(48):x}." for _ in range(7))
+        else:
+            content = json.dumps(grading)
+
+        return web.json_response({
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                      "total_tokens": (len(prompt) + len(content)) // 4},
+        })
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app, stats
+
+
+# === Подмена Telegram ===
+def make_fake_bot(token):
+    from telegram import Bot, Chat, Message
+
+    class FakeBot(Bot):
+        sent = 0
+
+        async def send_message(self, chat_id, text, *args, **kwargs):
+            FakeBot.sent += 1
+            return Message(message_id=FakeBot.sent, date=datetime.datetime.now(datetime.timezone.utc),
+                           chat=Chat(id=chat_id, type="group"), text=text)
+
+        async def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+            return True
+
+    return FakeBot(token)
+
+
+class UpdateFactory:
+    def __init__(self, fake_bot):
+        self.fake_bot = fake_bot
+        self.next_id = 0
+
+    def __call__(self, user_id, text):
+        from telegram import Update
+
+        self.next_id += 1
+        message = {
+            "message_id": self.next_id,
+            "date": int(time.time()),
+            "chat": {"id": BENCH_CHAT_ID, "type": "supergroup"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"bench{user_id}", "username": f"bench{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json({"update_id": self.next_id, "message": message}, self.fake_bot)
+
+
+class Context:
+    def __init__(self, fake_bot):
+        self.bot = fake_bot
+        self.args = []
+
+
+# === Сценарий участника ===
+async def run_user(bot, make_update, context, user_index, args, timings):
+    user_id = BENCH_USER_ID_BASE + user_index
+
+    async def timed(name, handler, text):
+        started = time.perf_counter()
+        await handler(make_update(user_id, text), context)
+        timings.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+
+    await asyncio.sleep(random.uniform(0, args.ramp_seconds))
+    await timed("letsgo", bot.letsgo, "/letsgo")
+
+    for i in range(args.messages_per_user):
+        await timed("log_message", bot.log_message, f"Сообщение {i} от участника {user_index}")
+
+    async with bot.get_db_connection() as conn:
+        cursor = await conn.execute(
+            "SELECT unique_id FROM daily_sentences WHERE user_id = %s AND date = CURRENT_DATE ORDER BY unique_id;",
+            (user_id,)
+        )
+        numbers = [row[0] for row in await cursor.fetchall()]
+
+    if numbers:
+        lines = "\n".join(f"{n}. Das ist meine Übersetzung Nummer {n} von {user_id}." for n in numbers)
+        await timed("check_user_translation", bot.check_user_translation, f"/translate\n{lines}")
+    await timed("user_stats", bot.user_stats, "/stats")
+    await timed("done", bot.done, "/done")
+
+
+# === Наблюдение за соединениями ===
+async def sample_connections(database_url, stop, samples, pool):
+    import psycopg
+
+    async with await psycopg.AsyncConnection.connect(database_url, autocommit=True) as conn:
+        while not stop.is_set():
+            cursor = await conn.execute(
+                "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid();"
+            )
+            pool_stats = pool.get_stats()
+            samples.append((
+                (await cursor.fetchone())[0],
+                pool_stats.get("pool_size", 0),
+                pool_stats.get("requests_waiting", 0),
+            ))
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), 0.1)
+
+
+# === Отчёт и базовая линия ===
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def summarize(timings, elapsed, graded, connection_samples):
+    handlers = {
+        name: {
+            "calls": len(values),
+            "p50": statistics.median(values),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values),
+        }
+        for name, values in timings.items()
+    }
+    total_calls = sum(len(values) for values in timings.values())
+    return {
+        "handlers": handlers,
+        "elapsed_s": elapsed,
+        "handlers_per_s": total_calls / elapsed,
+        "translations_per_s": graded / elapsed,
+        "db_connections_max": max((s[0] for s in connection_samples), default=0),
+        "db_connections_avg": statistics.mean(s[0] for s in connection_samples) if connection_samples else 0,
+        "pool_size_max": max((s[1] for s in connection_samples), default=0),
+        "pool_waiting_max": max((s[2] for s in connection_samples), default=0),
+    }
+
+
+def print_report(result):
+    print(f"\n{'обработчик':<24} | {'вызовов':>7} | {'p50, мс':>9} | {'p95, мс':>9} | {'p99, мс':>9} | {'max, мс':>9}")
+    print("-" * 82)
+    for name, h in result["handlers"].items():
+        print(f"{name:<24} | {h['calls']:>7} | {h['p50']:>9.1f} | {h['p95']:>9.1f} | {h['p99']:>9.1f} | {h['max']:>9.1f}")
+    print(
+        f"\n⏱ Время прогона: {result['elapsed_s']:.1f} с"
+        f"\n🔹 Обработчиков в секунду: {result['handlers_per_s']:.1f}"
+        f"\n🔹 Сохранённых переводов в секунду: {result['translations_per_s']:.1f}"
+        f"\n🗄 Соединений с базой: макс {result['db_connections_max']}, в среднем {result['db_connections_avg']:.1f}"
+        f"\n🗄 Пул бота: макс размер {result['pool_size_max']}, макс ожидающих {result['pool_waiting_max']}"
+    )
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """Возвращает список регрессий относительно базовой линии."""
+    regressions = []
+    for name, h in result["handlers"].items():
+        base = baseline["handlers"].get(name)
+        if not base:
+            continue
+        for metric in ("p95", "p99"):
+            if h[metric] > base[metric] * (1 + tolerance) and h[metric] - base[metric] > MIN_REGRESSION_MS:
+                regressions.append(f"{name} {metric}: {base[metric]:.1f} → {h[metric]:.1f} мс")
+    for metric in ("handlers_per_s", "translations_per_s"):
+        if result[metric] < baseline[metric] * (1 - tolerance):
+            regressions.append(f"{metric}: {baseline[metric]:.1f} → {result[metric]:.1f}")
+    if result["db_connections_max"] > baseline["db_connections_max"] * (1 + tolerance):
+        regressions.append(f"db_connections_max: {baseline['db_connections_max']} → {result['db_connections_max']}")
+    return regressions
+
+
+def scenario_key(args):
+    return (
+        f"users={args.users},messages={args.messages_per_user},latency={args.openai_latency_ms}"
+        f"±{args.openai_jitter_ms},mode={args.grading_mode}"
+    )
+
+
+# === Прогон ===
+async def run(args, database_url):
+    stub_app, stub_stats = start_openai_stub(args.openai_latency_ms, args.openai_jitter_ms)
+    runner = web.AppRunner(stub_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    stub_port = site._server.sockets[0].getsockname()[1]
+
+    # Бот читает настройки из окружения при импорте
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{stub_port}/v1",
+        "DATABASE_URL_RAILWAY": database_url,
+        "GRADING_MODE": args.grading_mode,
+        # Telegram здесь ненастоящий: лимиты отправки не должны растягивать прогон
+        "OUTBOUND_GLOBAL_PER_SECOND": "100000",
+        "OUTBOUND_GROUP_PER_MINUTE": "1000000",
+        "OUTBOUND_PRIVATE_PER_SECOND": "100000",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake_bot = make_fake_bot(os.environ["TELEGRAM_BOT_TOKEN"])
+    make_update = UpdateFactory(fake_bot)
+    context = Context(fake_bot)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        await bot.on_startup(None)
+    try:
+        async with bot.get_db_connection() as conn:
+            user_range = (BENCH_USER_ID_BASE, BENCH_USER_ID_BASE + args.users)
+            for table in ("translations", "daily_sentences", "daily_sentence_counters", "user_progress", "messages",
+                          "user_daily_stats", "chat_members_activity", "chat_member_months"):
+                await conn.execute(f"DELETE FROM {table} WHERE user_id >= %s AND user_id < %s;", user_range)
+            cursor = await conn.execute("SELECT count(*) FROM sentences;")
+            missing = max(0, args.sentences - (await cursor.fetchone())[0])
+            if missing:
+                await conn.execute("""
+                    INSERT INTO sentences (sentence)
+                    SELECT 'Тестовое предложение для нагрузки ' || md5(random()::text) || '.' FROM generate_series(1, %s);
+                """, (missing,))
+
+        timings = {}
+        connection_samples = []
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_connections(database_url, stop, connection_samples, bot.db_pool))
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(*(
+                run_user(bot, make_update, context, i, args, timings) for i in range(args.users)
+            ))
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        await sampler
+
+        # Пропускную способность считаем по реально сохранённым переводам, а не по отправленным номерам:
+        # отклонённые («уже переводили») и неоценённые переводы в translations не попадают
+        async with bot.get_db_connection() as conn:
+            cursor = await conn.execute(
+                "SELECT count(*) FROM translations WHERE user_id >= %s AND user_id < %s;", user_range
+            )
+            graded = (await cursor.fetchone())[0]
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await bot.on_shutdown(None)
+        await runner.cleanup()
+
+    result = summarize(timings, elapsed, graded, connection_samples)
+    result["openai_requests"] = stub_stats["requests"]
+    result["telegram_messages"] = type(fake_bot).sent
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages-per-user", type=int, default=5, help="Сообщений в чат на участника (log_message)")
+    parser.add_argument("--ramp-seconds", type=float, default=2.0, help="За сколько секунд подключаются все участники")
+    parser.add_argument("--openai-latency-ms", type=float, default=800)
+    parser.add_argument("--openai-jitter-ms", type=float, default=200)
+    parser.add_argument("--grading-mode", choices=("concurrent", "batch"), default="concurrent")
+    parser.add_argument("--sentences", type=int, default=2000, help="Минимальный размер банка предложений")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Сохранить результат как базовую линию")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение (0.2 = 20%%)")
+    parser.add_argument("--json", action="store_true", help="Вывести результат в JSON")
+    args = parser.parse_args()
+
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        raise SystemExit("❌ Укажите BENCH_DATABASE_URL (отдельную, не боевую базу).")
+    if database_url == os.getenv("DATABASE_URL_RAILWAY"):
+        raise SystemExit("❌ BENCH_DATABASE_URL совпадает с DATABASE_URL_RAILWAY — нужна отдельная база.")
+
+    result = asyncio.run(run(args, database_url))
+    print_report(result)
+    print(f"🔹 Запросов к OpenAI: {result['openai_requests']}, сообщений в Telegram: {result['telegram_messages']}")
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    key = scenario_key(args)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baselines = json.load(f)
+
+    if args.save_baseline:
+        baselines[key] = result
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Базовая линия сохранена: {args.baseline} [{key}]")
+        return
+
+    if key not in baselines:
+        print(f"\nℹ️ Базовой линии для [{key}] нет — сравнивать не с чем (см. --save-baseline).")
+        return
+
+    regressions = compare_with_baseline(result, baselines[key], args.tolerance)
+    if regressions:
+        print("\n❌ Регрессии относительно базовой линии:")
+        for line in regressions:
+            print(f"  - {line}")
+        raise SystemExit(1)
+    print("\n✅ Регрессий относительно базовой линии нет.")
+
+
+if __name__ == "__main__":
+    main()
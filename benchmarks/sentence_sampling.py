@@ -0,0 +1,123 @@
+"""Бенчмарк выборки случайных предложений для /letsgo и /getmore.
+
+Сравнивает три способа выбрать 5 предложений из банка размером 10k, 100k и 1M строк:
+  - ORDER BY RANDOM() LIMIT 5 (старый способ, сортировка всей таблицы);
+  - индекс по random_key (как в get_original_sentences), с исключением уже выданных пользователю;
+  - TABLESAMPLE SYSTEM (случайные страницы таблицы: быстро, но строки идут
+    пачками с одной страницы и выборка иногда оказывается неполной).
+
+Таблицы создаются в отдельной схеме bench и удаляются после прогона.
+
+Запуск:
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/sentence_sampling.py [--sizes 10000,100000,1000000] [--runs 50]
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+import psycopg
+
+SAMPLE_SIZE = 5
+SEEN_PER_USER = 500  # Сколько предложений «уже выдано» тестовому пользователю
+
+STRATEGIES = {
+    "ORDER BY RANDOM()": (
+        "SELECT sentence FROM bench.sentences ORDER BY RANDOM() LIMIT %(count)s;"
+    ),
+    "random_key + индекс": (
+        """
+        SELECT sentence FROM (
+            (SELECT s.sentence FROM bench.sentences s
+             WHERE s.random_key >= %(start)s
+               AND NOT EXISTS (SELECT 1 FROM bench.daily_sentences ds
+                               WHERE ds.user_id = 1 AND md5(ds.sentence) = md5(s.sentence))
+             ORDER BY s.random_key LIMIT %(count)s)
+            UNION ALL
+            (SELECT s.sentence FROM bench.sentences s
+             WHERE s.random_key < %(start)s
+               AND NOT EXISTS (SELECT 1 FROM bench.daily_sentences ds
+                               WHERE ds.user_id = 1 AND md5(ds.sentence) = md5(s.sentence))
+             ORDER BY s.random_key LIMIT %(count)s)
+        ) candidates LIMIT %(count)s;
+        """
+    ),
+    "TABLESAMPLE SYSTEM": (
+        "SELECT sentence FROM bench.sentences TABLESAMPLE SYSTEM (%(percent)s) LIMIT %(count)s;"
+    ),
+}
+
+
+def prepare(conn, size):
+    conn.execute("DROP SCHEMA IF EXISTS bench CASCADE;")
+    conn.execute("CREATE SCHEMA bench;")
+    conn.execute("""
+        CREATE TABLE bench.sentences (
+            id SERIAL PRIMARY KEY,
+            sentence TEXT NOT NULL,
+            random_key DOUBLE PRECISION NOT NULL DEFAULT random()
+        );
+    """)
+    conn.execute("""
+        INSERT INTO bench.sentences (sentence)
+        SELECT 'Тестовое предложение номер ' || g || ' для проверки выборки.' FROM generate_series(1, %s) g;
+    """, (size,))
+    conn.execute("CREATE INDEX ON bench.sentences (random_key);")
+    conn.execute("""
+        CREATE TABLE bench.daily_sentences (
+            id SERIAL PRIMARY KEY,
+            sentence TEXT NOT NULL,
+            user_id BIGINT
+        );
+    """)
+    conn.execute("""
+        INSERT INTO bench.daily_sentences (sentence, user_id)
+        SELECT sentence, 1 FROM bench.sentences ORDER BY id LIMIT %s;
+    """, (SEEN_PER_USER,))
+    conn.execute("CREATE INDEX ON bench.daily_sentences (user_id, md5(sentence));")
+    conn.execute("ANALYZE bench.sentences; ANALYZE bench.daily_sentences;")
+
+
+def measure(conn, query, size, runs):
+    # Процент страниц для TABLESAMPLE: с запасом, чтобы набралось SAMPLE_SIZE строк
+    percent = min(100.0, max(0.01, 100.0 * SAMPLE_SIZE * 20 / size))
+    timings = []
+    short = 0  # Сколько раз вернулось меньше SAMPLE_SIZE строк
+    for _ in range(runs):
+        params = {"count": SAMPLE_SIZE, "start": random.random(), "percent": percent}
+        started = time.perf_counter()
+        rows = conn.execute(query, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+        short += len(rows) < SAMPLE_SIZE
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], short
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        raise SystemExit("❌ Укажите BENCH_DATABASE_URL (отдельную, не боевую базу).")
+    if database_url == os.getenv("DATABASE_URL_RAILWAY"):
+        raise SystemExit("❌ BENCH_DATABASE_URL совпадает с DATABASE_URL_RAILWAY — нужна отдельная база.")
+
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        print(f"{'строк':>10} | {'способ':<22} | {'медиана, мс':>12} | {'p95, мс':>9} | {'неполных':>8}")
+        print("-" * 73)
+        try:
+            for size in (int(x) for x in args.sizes.split(",")):
+                prepare(conn, size)
+                for name, query in STRATEGIES.items():
+                    median, p95, short = measure(conn, query, size, args.runs)
+                    print(f"{size:>10} | {name:<22} | {median:>12.2f} | {p95:>9.2f} | {short:>8}")
+        finally:
+            conn.execute("DROP SCHEMA IF EXISTS bench CASCADE;")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,28 @@
 import os
 import logging
 import openai
-import psycopg2
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 import datetime
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
+from telegram import ChatMember, Update
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, MessageHandler, filters, CallbackContext
+from datetime import datetime, timedelta
 import asyncio
-import requests
+import contextlib
+import functools
+import hashlib
+import json
+import random
+import re
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict, deque
+from zoneinfo import ZoneInfo
+import httpx
+from pydantic import BaseModel, Field, ValidationError, field_validator
 
 
 # Ваш API-ключ для mediastack
@@ -25,6 +39,9 @@ print(f"DEBUG: TELEGRAM_BOT_TOKEN = {repr(TELEGRAM_BOT_TOKEN)}")
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("❌ Ошибка: TELEGRAM_BOT_TOKEN не задан. Проверь переменные окружения!")
 
+# Группа по умолчанию: к ней относятся данные, накопленные до поддержки нескольких групп,
+# и команды из лички от пользователей, ещё не активных ни в одной группе.
+# Остальные группы регистрируются в chat_groups автоматически при первом сообщении.
 GROUP_CHAT_ID = -1002347376305  # ID вашей группы
 #GROUP_CHAT_ID = os.getenv("GROUP_CHAT_ID", "").strip()
 
@@ -32,6 +49,28 @@ if not GROUP_CHAT_ID:
     raise ValueError("❌ Ошибка: GROUP_CHAT_ID не задан. Проверь переменные окружения!")
 GROUP_CHAT_ID = int(GROUP_CHAT_ID)
 
+ADMIN_ID = 117649764  # Telegram ID администратора (служебные команды)
+
+# Часовой пояс, в котором заданы времена рассылок и отчётов (по умолчанию — время сервера Railway, UTC)
+BOT_TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "UTC"))
+JOB_MISFIRE_GRACE_SECONDS = int(os.getenv("JOB_MISFIRE_GRACE_SECONDS", "900"))
+GROUP_JOB_CONCURRENCY = int(os.getenv("GROUP_JOB_CONCURRENCY", "10"))  # Сколько групп задача по расписанию обходит одновременно
+
+# 🔹 Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")  # Публичный адрес бота, например https://bot.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))  # Railway передаёт порт в PORT
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "").strip()  # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "8"))  # Сколько обновлений (разных пользователей) обрабатывается одновременно
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").strip().rstrip("/")  # Для локального тестового сервера вместо api.telegram.org
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"❌ Ошибка: неизвестный BOT_MODE={BOT_MODE!r}. Допустимо: polling, webhook.")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET_TOKEN):
+    raise ValueError("❌ Ошибка: для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET_TOKEN. Проверь переменные окружения!")
+
 print("🚀 Все переменные окружения Railway:")
 for key, value in os.environ.items():
     print(f"{key}: {value[:10]}...")  # Выводим первые 10 символов для безопасности
@@ -48,37 +87,180 @@ if not openai.api_key:
 
 
 
+# === Метрики (Prometheus) ===
+# Отдаются на локальном HTTP-эндпоинте http://METRICS_ADDR:METRICS_PORT/metrics (METRICS_PORT=0 — выключено).
+# Новые обработчики и задачи по расписанию достаточно обернуть в @instrumented.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время выполнения обработчиков и задач", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors", "Исключения в обработчиках и задачах", ["handler"])
+OPENAI_SECONDS = Histogram(
+    "bot_openai_request_seconds", "Время запроса к OpenAI", ["operation", "outcome"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+OPENAI_TOKENS = Counter("bot_openai_tokens", "Токены OpenAI", ["operation", "kind"])
+OPENAI_RETRIES = Counter("bot_openai_retries", "Повторы запросов к OpenAI", ["operation", "reason"])
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Время SQL-запросов по именам", ["query"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+DB_POOL_CONNECTIONS = Gauge("bot_db_pool_connections", "Состояние пула соединений", ["state"])
+TELEGRAM_SEND_SECONDS = Histogram("bot_telegram_send_seconds", "Время вызова send_message", ["outcome"])
+OUTBOUND_WAIT_SECONDS = Histogram(
+    "bot_outbound_wait_seconds", "Время от постановки сообщения в очередь до отправки",
+    buckets=(0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+
+def instrumented(name=None):
+    """Декоратор для обработчиков и задач: время выполнения и исключения в метриках.
+
+    Можно писать и `@instrumented`, и `@instrumented("имя")`.
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.labels(label).inc()
+                raise
+            finally:
+                HANDLER_SECONDS.labels(label).observe(time.perf_counter() - started)
+        return wrapper
+
+    if callable(name):  # @instrumented без скобок
+        func, name = name, None
+        return decorator(func)
+    return decorator
+
+
+def record_openai_call(operation, started, outcome, response=None):
+    """Записывает время запроса к OpenAI и потраченные токены."""
+    OPENAI_SECONDS.labels(operation, outcome).observe(time.perf_counter() - started)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        OPENAI_TOKENS.labels(operation, "prompt").inc(usage.prompt_tokens or 0)
+        OPENAI_TOKENS.labels(operation, "completion").inc(usage.completion_tokens or 0)
+
+
+@functools.lru_cache(maxsize=1024)
+def query_name(query):
+    """Имя запроса для метрик: из комментария `-- query: имя`, иначе «глагол таблица» (например, `select daily_sentences`)."""
+    explicit = re.search(r"--\s*query:\s*([\w.-]+)", query)
+    if explicit:
+        return explicit.group(1)
+    text = re.sub(r"--[^\n]*", " ", query)
+    verb = re.search(r"\b(with|select|insert|update|delete|lock|create|truncate)\b", text, re.IGNORECASE)
+    table = re.search(
+        r"\b(?:from|into|update|table|index)\s+(?:if\s+(?:not\s+)?exists\s+)?([a-z_][\w.]*)", text, re.IGNORECASE
+    )
+    return " ".join(part.group(1).lower() for part in (verb, table) if part) or "other"
+
+
+class InstrumentedCursor(psycopg.AsyncCursor):
+    """Курсор, который замеряет время каждого запроса (используется всеми соединениями пула)."""
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            label = query_name(query) if isinstance(query, str) else "composed"
+            DB_QUERY_SECONDS.labels(label).observe(time.perf_counter() - started)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            label = query_name(query) if isinstance(query, str) else "composed"
+            DB_QUERY_SECONDS.labels(f"{label} (many)").observe(time.perf_counter() - started)
+
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    try:
+        start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+        print(f"📈 Метрики доступны на http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logging.warning(f"⚠️ Не удалось запустить сервер метрик на порту {METRICS_PORT}: {e}")
+
+
+
 # === Подключение к базе данных PostgreSQL ===
 DATABASE_URL = os.getenv("DATABASE_URL_RAILWAY")
 if not DATABASE_URL:
     raise ValueError("❌ Ошибка: DATABASE_URL не задан. Проверь переменные окружения!")
 
+# Размеры пула и таймаут ожидания свободного соединения (в секундах)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+db_pool = None  # Общий асинхронный пул соединений, создаётся при старте Application
+
+
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
-
-# Проверка подключения
-conn = get_db_connection()
-cursor = conn.cursor()
-cursor.execute("SELECT version();")
-db_version = cursor.fetchone()
-print(f"✅ База данных подключена! Версия: {db_version}")
-cursor.close()
-conn.close()
-
-def initialize_database():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Таблица с оригинальными предложениями
-    cursor.execute("""
+    """Берёт соединение из общего пула: `async with get_db_connection() as conn: ...`
+
+    При выходе из блока транзакция фиксируется (или откатывается при ошибке),
+    а соединение возвращается в пул.
+    """
+    return db_pool.connection()
+
+
+async def init_db_pool():
+    """Создаёт пул соединений и проверяет подключение к базе."""
+    global db_pool
+    db_pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        kwargs={"cursor_factory": InstrumentedCursor},
+        open=False,
+    )
+    for state in ("pool_size", "pool_available", "requests_waiting"):
+        DB_POOL_CONNECTIONS.labels(state).set_function(
+            lambda state=state: db_pool.get_stats().get(state, 0) if db_pool is not None else 0
+        )
+    await db_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+
+    # Проверка подключения
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT version();")
+            db_version = await cursor.fetchone()
+    print(f"✅ База данных подключена! Версия: {db_version}")
+
+
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+        print("✅ Пул соединений с базой данных закрыт.")
+
+
+# === Миграции схемы базы данных ===
+# Каждая миграция применяется один раз, по возрастанию версии; применённые версии
+# записываются в schema_migrations. Схему меняем только новой миграцией в конце
+# списка — уже применённые миграции не редактируем.
+MIGRATIONS = [
+    (1, "Базовые таблицы", """
+        -- Таблица с оригинальными предложениями
         CREATE TABLE IF NOT EXISTS sentences (
             id SERIAL PRIMARY KEY,
             sentence TEXT NOT NULL
         );
-    """)
 
-    # ✅ Таблица для переводов пользователей
-    cursor.execute("""
+        -- Таблица для переводов пользователей
         CREATE TABLE IF NOT EXISTS translations (
             id SERIAL PRIMARY KEY,
             user_id BIGINT NOT NULL,
@@ -89,10 +271,8 @@ def initialize_database():
             feedback TEXT,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
 
-    # ✅ Новая таблица для всех сообщений пользователей (чтобы учитывать ленивых)
-    cursor.execute("""
+        -- Все сообщения пользователей (чтобы учитывать ленивых)
         CREATE TABLE IF NOT EXISTS messages (
             id SERIAL PRIMARY KEY,
             user_id BIGINT NOT NULL,
@@ -100,20 +280,17 @@ def initialize_database():
             message TEXT NOT NULL,
             timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
         );
-    """)
 
-
-    cursor.execute("""
+        -- Предложения, выданные пользователям
         CREATE TABLE IF NOT EXISTS daily_sentences (
             id SERIAL PRIMARY KEY,
             date DATE NOT NULL DEFAULT CURRENT_DATE,
             sentence TEXT NOT NULL,
             unique_id INT NOT NULL,
-            user_id BIGINT  -- 🆕 Теперь указываем пользователя, которому назначено предложение
+            user_id BIGINT
         );
-    """)
-    
-    cursor.execute("""
+
+        -- Сессии перевода
         CREATE TABLE IF NOT EXISTS user_progress (
             id SERIAL PRIMARY KEY,
             user_id BIGINT,
@@ -123,49 +300,1108 @@ def initialize_database():
             completed BOOLEAN DEFAULT FALSE,
             CONSTRAINT unique_user_session UNIQUE (user_id, start_time)
         );
-    """)
+    """),
+    (2, "Пул предложений, кэш оценок и выборка по random_key", """
+        -- Пул сгенерированных GPT предложений (запас на случай пустой таблицы sentences)
+        CREATE TABLE IF NOT EXISTS sentence_pool (
+            id SERIAL PRIMARY KEY,
+            sentence TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
 
+        -- Кэш оценок GPT: одинаковый перевод одного и того же предложения не проверяем повторно
+        CREATE TABLE IF NOT EXISTS grading_cache (
+            cache_key TEXT PRIMARY KEY,
+            score INT NOT NULL,
+            feedback TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_hit_at TIMESTAMPTZ
+        );
 
-    conn.commit()
-    cursor.close()
-    conn.close()
-    print("✅ Таблицы sentences, translations и messages проверены и готовы к использованию.")
+        -- Случайный ключ для выборки предложений по индексу вместо ORDER BY RANDOM()
+        ALTER TABLE sentences ADD COLUMN IF NOT EXISTS random_key DOUBLE PRECISION NOT NULL DEFAULT random();
+        CREATE INDEX IF NOT EXISTS idx_sentences_random_key ON sentences (random_key);
+
+        -- Быстрая проверка «это предложение пользователю уже выдавали»
+        CREATE INDEX IF NOT EXISTS idx_daily_sentences_user_sentence ON daily_sentences (user_id, md5(sentence));
+    """),
+    (3, "Индексы для горячих запросов", """
+        -- /translate, /done, /stats: предложения пользователя за день и поиск по номеру
+        CREATE INDEX IF NOT EXISTS idx_daily_sentences_user_date ON daily_sentences (user_id, date, unique_id);
+        -- Отчёты по всем пользователям за день и за неделю
+        CREATE INDEX IF NOT EXISTS idx_daily_sentences_date ON daily_sentences (date);
+
+        -- «Уже переводил это предложение?» и связь с daily_sentences в отчётах
+        CREATE INDEX IF NOT EXISTS idx_translations_user_sentence ON translations (user_id, sentence_id);
+        -- Переводы пользователя за день / неделю
+        CREATE INDEX IF NOT EXISTS idx_translations_user_timestamp ON translations (user_id, timestamp);
+        -- Активные за день пользователи в отчётах
+        CREATE INDEX IF NOT EXISTS idx_translations_timestamp ON translations (timestamp);
+
+        -- Открытые сессии (/letsgo, /done, автозавершение): их мало, частичный индекс компактный
+        CREATE INDEX IF NOT EXISTS idx_user_progress_open ON user_progress (user_id, start_time) WHERE completed = FALSE;
+        -- Время сессий за день / неделю в отчётах
+        CREATE INDEX IF NOT EXISTS idx_user_progress_start_time ON user_progress (start_time);
+
+        -- Кто писал в чат в этом месяце (ленивцы)
+        CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+
+        -- Вытеснение старых записей кэша оценок
+        CREATE INDEX IF NOT EXISTS idx_grading_cache_last_used ON grading_cache ((COALESCE(last_hit_at, created_at)));
+    """),
+    (4, "Агрегаты статистики по дням (user_daily_stats)", """
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            user_id BIGINT NOT NULL,
+            date DATE NOT NULL,
+            username TEXT,
+            assigned INT NOT NULL DEFAULT 0,                      -- Выдано предложений
+            translated INT NOT NULL DEFAULT 0,                    -- Переведено
+            score_sum BIGINT NOT NULL DEFAULT 0,                  -- Сумма оценок
+            scored INT NOT NULL DEFAULT 0,                        -- Переводов с оценкой (для среднего)
+            sessions INT NOT NULL DEFAULT 0,                      -- Завершённых сессий
+            session_minutes DOUBLE PRECISION NOT NULL DEFAULT 0,  -- Их общее время
+            PRIMARY KEY (user_id, date)
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_daily_stats_date ON user_daily_stats (date);
+
+        -- Заполняем по уже накопленным данным
+        INSERT INTO user_daily_stats (user_id, date, username, assigned, translated, score_sum, scored, sessions, session_minutes)
+        SELECT
+            COALESCE(a.user_id, s.user_id),
+            COALESCE(a.date, s.date),
+            COALESCE(s.username, a.username,
+                (SELECT MAX(up.username) FROM user_progress up WHERE up.user_id = COALESCE(a.user_id, s.user_id))),
+            COALESCE(a.assigned, 0),
+            COALESCE(a.translated, 0),
+            COALESCE(a.score_sum, 0),
+            COALESCE(a.scored, 0),
+            COALESCE(s.sessions, 0),
+            COALESCE(s.session_minutes, 0)
+        FROM (
+            -- Выданные предложения и переводы к ним (по дате выдачи предложения)
+            SELECT ds.user_id, ds.date, MAX(t.username) AS username,
+                COUNT(DISTINCT ds.id) AS assigned,
+                COUNT(DISTINCT t.id) AS translated,
+                COALESCE(SUM(t.score), 0) AS score_sum,
+                COUNT(t.score) AS scored
+            FROM daily_sentences ds
+            LEFT JOIN translations t ON t.user_id = ds.user_id AND t.sentence_id = ds.id
+            WHERE ds.user_id IS NOT NULL
+            GROUP BY ds.user_id, ds.date
+        ) a
+        FULL JOIN (
+            -- Завершённые сессии (по дате начала)
+            SELECT user_id, start_time::date AS date, MAX(username) AS username,
+                COUNT(*) AS sessions,
+                SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60) AS session_minutes
+            FROM user_progress
+            WHERE completed = TRUE AND end_time IS NOT NULL AND user_id IS NOT NULL
+            GROUP BY user_id, start_time::date
+        ) s ON s.user_id = a.user_id AND s.date = a.date
+        ON CONFLICT (user_id, date) DO NOTHING;
+    """),
+    (5, "Кэш новостей (news_articles)", """
+        -- Статьи, полученные из новостного API; url уникален, поэтому одна статья не придёт дважды
+        CREATE TABLE IF NOT EXISTS news_articles (
+            id SERIAL PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            source TEXT,
+            published_at TIMESTAMPTZ,
+            first_seen DATE NOT NULL DEFAULT CURRENT_DATE
+        );
+        CREATE INDEX IF NOT EXISTS idx_news_articles_first_seen ON news_articles (first_seen);
 
+        -- Дни, за которые новости уже запрашивались: повторный запуск берёт статьи из кэша
+        CREATE TABLE IF NOT EXISTS news_fetches (
+            date DATE PRIMARY KEY,
+            fetched_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            articles INT NOT NULL
+        );
+    """),
+    (6, "Эталонные переводы для локальной предпроверки", r"""
+        -- Верные переводы предложений (из ответов GPT и из переводов пользователей с высокой оценкой).
+        -- sentence_hash — sha256 от предложения в Unicode NFC со схлопнутыми пробелами (как normalize_for_cache)
+        CREATE TABLE IF NOT EXISTS reference_translations (
+            id SERIAL PRIMARY KEY,
+            sentence_hash TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (sentence_hash, translation)
+        );
 
+        INSERT INTO reference_translations (sentence_hash, translation, source)
+        SELECT sentence_hash, translation, source
+        FROM (
+            SELECT
+                encode(sha256(convert_to(normalize(regexp_replace(btrim(ds.sentence), '\s+', ' ', 'g'), NFC), 'UTF8')), 'hex') AS sentence_hash,
+                btrim(substring(t.feedback FROM 'Верный перевод:\s*([^\n]+)'), ' *"«»') AS translation,
+                'gpt' AS source
+            FROM translations t
+            JOIN daily_sentences ds ON ds.id = t.sentence_id
+            UNION ALL
+            SELECT
+                encode(sha256(convert_to(normalize(regexp_replace(btrim(ds.sentence), '\s+', ' ', 'g'), NFC), 'UTF8')), 'hex'),
+                btrim(t.user_translation),
+                'user'
+            FROM translations t
+            JOIN daily_sentences ds ON ds.id = t.sentence_id
+            WHERE t.score >= 95
+        ) refs
+        WHERE translation IS NOT NULL AND translation <> ''
+        ON CONFLICT (sentence_hash, translation) DO NOTHING;
+    """),
+    (7, "Оценки переводов в типизированных колонках", """
+        -- Поля оценки (GradingResult) отдельными колонками; feedback остаётся только у старых строк
+        ALTER TABLE translations ADD COLUMN IF NOT EXISTS errors TEXT;
+        ALTER TABLE translations ADD COLUMN IF NOT EXISTS correct_translation TEXT;
+        ALTER TABLE translations ADD COLUMN IF NOT EXISTS synonym TEXT;
+
+        -- Оценки, которые строгая регулярка не разобрала (NULL), достаём из текста и досчитываем в user_daily_stats
+        WITH recovered AS (
+            UPDATE translations
+            SET score = LEAST(substring(feedback FROM '(\\d{1,3})\\s*/\\s*100')::INT, 100)
+            WHERE score IS NULL AND feedback ~ '\\d{1,3}\\s*/\\s*100'
+            RETURNING user_id, sentence_id, score
+        )
+        UPDATE user_daily_stats u
+        SET score_sum = u.score_sum + r.score_sum, scored = u.scored + r.scored
+        FROM (
+            SELECT r.user_id, ds.date, SUM(r.score) AS score_sum, COUNT(*) AS scored
+            FROM recovered r
+            JOIN daily_sentences ds ON ds.id = r.sentence_id
+            GROUP BY r.user_id, ds.date
+        ) r
+        WHERE u.user_id = r.user_id AND u.date = r.date;
+
+        -- Остальные поля разбираем из старого текстового feedback
+        UPDATE translations SET
+            errors = NULLIF(btrim(substring(feedback FROM 'Ошибки:\\s*(.*?)\\s*Верный перевод:')), ''),
+            correct_translation = NULLIF(btrim(substring(feedback FROM 'Верный перевод:\\s*([^\\n]*)'), ' *"«»'), ''),
+            synonym = NULLIF(btrim(substring(feedback FROM 'Синоним:\\s*([^\\n]*)'), ' *'), '')
+        WHERE feedback IS NOT NULL AND correct_translation IS NULL;
+
+        -- Кэш хранит оценку целиком как JSON; старые записи всё равно не совпали бы по версии промпта
+        TRUNCATE grading_cache;
+        ALTER TABLE grading_cache DROP COLUMN IF EXISTS score;
+        ALTER TABLE grading_cache DROP COLUMN IF EXISTS feedback;
+        ALTER TABLE grading_cache ADD COLUMN IF NOT EXISTS result JSONB NOT NULL;
+    """),
+    (8, "Несколько групп: chat_groups и chat_id во всех таблицах", f"""
+        -- Группы, которые обслуживает бот, и их настройки (часы в BOT_TIMEZONE)
+        CREATE TABLE IF NOT EXISTS chat_groups (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            active BOOLEAN NOT NULL DEFAULT TRUE,                 -- FALSE: бота удалили из группы или рассылки выключены
+            report_hours INT[] NOT NULL DEFAULT ARRAY[9, 13, 17], -- Часы промежуточных итогов
+            morning_messages BOOLEAN NOT NULL DEFAULT TRUE,       -- Утренние напоминания и задания
+            news_enabled BOOLEAN NOT NULL DEFAULT TRUE,           -- Новости на немецком
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        INSERT INTO chat_groups (chat_id) VALUES ({GROUP_CHAT_ID}) ON CONFLICT (chat_id) DO NOTHING;
+
+        -- Все накопленные данные относятся к группе по умолчанию
+        -- (ADD COLUMN с DEFAULT не переписывает таблицу; DEFAULT потом убираем, chat_id всегда задаёт код)
+        ALTER TABLE daily_sentences ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT {GROUP_CHAT_ID};
+        ALTER TABLE translations ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT {GROUP_CHAT_ID};
+        ALTER TABLE user_progress ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT {GROUP_CHAT_ID};
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT {GROUP_CHAT_ID};
+        ALTER TABLE user_daily_stats ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT {GROUP_CHAT_ID};
+        ALTER TABLE daily_sentences ALTER COLUMN chat_id DROP DEFAULT;
+        ALTER TABLE translations ALTER COLUMN chat_id DROP DEFAULT;
+        ALTER TABLE user_progress ALTER COLUMN chat_id DROP DEFAULT;
+        ALTER TABLE messages ALTER COLUMN chat_id DROP DEFAULT;
+        ALTER TABLE user_daily_stats ALTER COLUMN chat_id DROP DEFAULT;
+
+        -- Один пользователь может учиться в нескольких группах
+        ALTER TABLE user_daily_stats DROP CONSTRAINT user_daily_stats_pkey;
+        ALTER TABLE user_daily_stats ADD PRIMARY KEY (chat_id, user_id, date);
+        ALTER TABLE user_progress DROP CONSTRAINT unique_user_session;
+        ALTER TABLE user_progress ADD CONSTRAINT unique_user_session UNIQUE (chat_id, user_id, start_time);
+
+        -- Индексы горячих запросов теперь начинаются с группы
+        DROP INDEX IF EXISTS idx_daily_sentences_user_date;
+        DROP INDEX IF EXISTS idx_daily_sentences_date;
+        DROP INDEX IF EXISTS idx_translations_timestamp;
+        DROP INDEX IF EXISTS idx_user_progress_open;
+        DROP INDEX IF EXISTS idx_user_progress_start_time;
+        DROP INDEX IF EXISTS idx_messages_timestamp;
+        DROP INDEX IF EXISTS idx_user_daily_stats_date;
+        CREATE INDEX IF NOT EXISTS idx_daily_sentences_chat_user_date ON daily_sentences (chat_id, user_id, date, unique_id);
+        CREATE INDEX IF NOT EXISTS idx_daily_sentences_chat_date ON daily_sentences (chat_id, date);
+        CREATE INDEX IF NOT EXISTS idx_translations_chat_timestamp ON translations (chat_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_user_progress_open ON user_progress (chat_id, user_id, start_time) WHERE completed = FALSE;
+        CREATE INDEX IF NOT EXISTS idx_user_progress_chat_start_time ON user_progress (chat_id, start_time);
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages (chat_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_user_daily_stats_chat_date ON user_daily_stats (chat_id, date);
+    """),
+    (9, "Помесячные партиции messages и translations", """
+        -- Партиция таблицы `parent` за месяц, в который попадает `month` (имя: parent_yYYYYmMM).
+        -- Вызывается из миграции и из задачи maintain_partitions, которая создаёт партиции заранее.
+        CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month DATE) RETURNS VOID AS $$
+        DECLARE
+            start_date DATE := date_trunc('month', month)::date;
+        BEGIN
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                parent || to_char(start_date, '"_y"YYYY"m"MM'), parent, start_date, (start_date + INTERVAL '1 month')::date
+            );
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Сюда уходят отсоединённые старые партиции (PARTITION_RETENTION_MODE=detach)
+        CREATE SCHEMA IF NOT EXISTS archive;
+
+        -- Последовательности id переживут удаление старых таблиц
+        ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+        ALTER SEQUENCE translations_id_seq OWNED BY NONE;
+        ALTER TABLE messages RENAME TO messages_unpartitioned;
+        ALTER TABLE translations RENAME TO translations_unpartitioned;
+
+        -- Первичный ключ партиционированной таблицы обязан включать ключ партиционирования
+        CREATE TABLE messages (
+            id INT NOT NULL DEFAULT nextval('messages_id_seq'),
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            username TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
 
-# Вызываем при старте бота
-initialize_database()
+        CREATE TABLE translations (
+            id INT NOT NULL DEFAULT nextval('translations_id_seq'),
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            username TEXT,
+            sentence_id INT NOT NULL,
+            user_translation TEXT NOT NULL,
+            score INT,
+            errors TEXT,
+            correct_translation TEXT,
+            synonym TEXT,
+            feedback TEXT,  -- Только у строк, сохранённых до миграции 7
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+        ALTER SEQUENCE translations_id_seq OWNED BY translations.id;
+
+        -- Партиции за месяцы, в которых есть данные, и на два месяца вперёд;
+        -- DEFAULT-партиция страхует вставку, если задача по какой-то причине не создала партицию заранее
+        SELECT create_monthly_partition('messages', month::date)
+        FROM (
+            SELECT DISTINCT date_trunc('month', timestamp) AS month FROM messages_unpartitioned WHERE timestamp IS NOT NULL
+            UNION
+            SELECT generate_series(date_trunc('month', NOW()), date_trunc('month', NOW()) + INTERVAL '2 months', INTERVAL '1 month')
+        ) months;
+        SELECT create_monthly_partition('translations', month::date)
+        FROM (
+            SELECT DISTINCT date_trunc('month', timestamp) AS month FROM translations_unpartitioned WHERE timestamp IS NOT NULL
+            UNION
+            SELECT generate_series(date_trunc('month', NOW()), date_trunc('month', NOW()) + INTERVAL '2 months', INTERVAL '1 month')
+        ) months;
+        CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+        CREATE TABLE translations_default PARTITION OF translations DEFAULT;
+
+        -- Строки без времени (код бота их не создаёт) попадают в DEFAULT-партицию с датой 1970-01-01
+        -- (если такого месяца нет среди партиций)
+        INSERT INTO messages (id, chat_id, user_id, username, message, timestamp)
+        SELECT id, chat_id, user_id, username, message, COALESCE(timestamp, 'epoch')
+        FROM messages_unpartitioned;
+        INSERT INTO translations (id, chat_id, user_id, username, sentence_id, user_translation, score,
+                                  errors, correct_translation, synonym, feedback, timestamp)
+        SELECT id, chat_id, user_id, username, sentence_id, user_translation, score,
+               errors, correct_translation, synonym, feedback, COALESCE(timestamp, 'epoch')
+        FROM translations_unpartitioned;
+        DROP TABLE messages_unpartitioned;
+        DROP TABLE translations_unpartitioned;
+
+        -- Индексы создаются на каждой партиции; запросы за месяц или день читают только свои партиции
+        CREATE INDEX idx_messages_chat_timestamp ON messages (chat_id, timestamp);
+        CREATE INDEX idx_translations_user_sentence ON translations (user_id, sentence_id);
+        CREATE INDEX idx_translations_user_timestamp ON translations (user_id, timestamp);
+        CREATE INDEX idx_translations_chat_timestamp ON translations (chat_id, timestamp);
+    """),
+    (10, "Активность участников групп (chat_members_activity)", """
+        -- Последнее имя и время активности каждого участника группы
+        CREATE TABLE IF NOT EXISTS chat_members_activity (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            username TEXT,
+            first_seen TIMESTAMPTZ NOT NULL,
+            last_seen TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        );
 
+        -- Сколько сообщений участник написал в группе за месяц (ленивцы — все, кто есть за текущий месяц)
+        CREATE TABLE IF NOT EXISTS chat_member_months (
+            chat_id BIGINT NOT NULL,
+            month DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            messages INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, month, user_id)
+        );
 
+        -- Заполняем по уже накопленному журналу сообщений
+        INSERT INTO chat_members_activity (chat_id, user_id, username, first_seen, last_seen)
+        SELECT DISTINCT ON (chat_id, user_id) chat_id, user_id, username,
+            MIN(timestamp) OVER (PARTITION BY chat_id, user_id), timestamp
+        FROM messages
+        ORDER BY chat_id, user_id, timestamp DESC
+        ON CONFLICT (chat_id, user_id) DO NOTHING;
 
-# Функция для получения новостей на немецком
-async def send_german_news(context: CallbackContext):
-    url = f"http://api.mediastack.com/v1/news?access_key={API_KEY_NEWS}&languages=de&technology&countries=de,au&limit=2" # Ограничим до 3 новостей
-    #url = f"http://api.mediastack.com/v1/news?access_key={API_KEY_NEWS}&languages=de&countries=at&limit=3" for Austria
-
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        data = response.json()
-
-        if "data" in data and len(data["data"]) > 0:
-            print("📢 Nachrichten auf Deutsch:")
-            for i, article in enumerate(data["data"], start=1):  # Ограничим до 3 новостей in API request
-                title = article.get("title", "Без заголовка")
-                source = article.get("source", "Неизвестный источник")
-                url = article.get("url", "#")
-
-                message = f"📰 {i}. *{title}*\n\n📌 {source}\n\n[Читать полностью]({url})"
-                await context.bot.send_message(
-                    chat_id=GROUP_CHAT_ID,
-                    text=message,
-                    parse_mode="Markdown",
-                    disable_web_page_preview=False  # Чтобы загружались превью страниц
+        INSERT INTO chat_member_months (chat_id, month, user_id, messages)
+        SELECT chat_id, date_trunc('month', timestamp)::date, user_id, COUNT(*)
+        FROM messages
+        GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, month, user_id) DO NOTHING;
+    """),
+    (11, "Счётчики номеров заданий и уникальный номер в daily_sentences", """
+        -- Последний выданный номер задания пользователя в группе за день.
+        -- Строка-счётчик блокируется при выдаче, поэтому параллельные /letsgo и /getmore нумеруют без дыр и повторов.
+        CREATE TABLE IF NOT EXISTS daily_sentence_counters (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            date DATE NOT NULL,
+            last_unique_id INT NOT NULL,
+            PRIMARY KEY (chat_id, user_id, date)
+        );
+
+        -- Дубли номеров (от прежних гонок при двойном нажатии) перенумеровываем в конец дня
+        WITH copies AS (
+            SELECT id, chat_id, user_id, date,
+                ROW_NUMBER() OVER (PARTITION BY chat_id, user_id, date, unique_id ORDER BY id) AS copy_no
+            FROM daily_sentences
+        ),
+        renumbered AS (
+            SELECT c.id,
+                m.max_unique_id + ROW_NUMBER() OVER (PARTITION BY c.chat_id, c.user_id, c.date ORDER BY c.id) AS unique_id
+            FROM copies c
+            JOIN (
+                SELECT chat_id, user_id, date, MAX(unique_id) AS max_unique_id
+                FROM daily_sentences
+                GROUP BY chat_id, user_id, date
+            ) m ON m.chat_id = c.chat_id AND m.user_id = c.user_id AND m.date = c.date
+            WHERE c.copy_no > 1
+        )
+        UPDATE daily_sentences ds SET unique_id = r.unique_id FROM renumbered r WHERE ds.id = r.id;
+
+        INSERT INTO daily_sentence_counters (chat_id, user_id, date, last_unique_id)
+        SELECT chat_id, user_id, date, MAX(unique_id)
+        FROM daily_sentences
+        WHERE user_id IS NOT NULL AND unique_id IS NOT NULL
+        GROUP BY chat_id, user_id, date
+        ON CONFLICT (chat_id, user_id, date) DO NOTHING;
+
+        -- Уникальный индекс заменяет обычный idx_daily_sentences_chat_user_date с теми же колонками
+        DROP INDEX IF EXISTS idx_daily_sentences_chat_user_date;
+        ALTER TABLE daily_sentences
+            ADD CONSTRAINT daily_sentences_chat_user_date_unique_id UNIQUE (chat_id, user_id, date, unique_id);
+    """),
+    (12, "Отметка о переводе в daily_sentences (translated_at)", """
+        -- Уникальный ключ (user_id, sentence_id) на секционированной translations невозможен
+        -- (он обязан включать timestamp), поэтому «засчитан только первый перевод» держится
+        -- на этой колонке: перевод сохраняется, только если удалось выставить translated_at.
+        ALTER TABLE daily_sentences ADD COLUMN IF NOT EXISTS translated_at TIMESTAMP;
+
+        UPDATE daily_sentences ds SET translated_at = t.first_translated_at
+        FROM (
+            SELECT sentence_id, MIN(timestamp) AS first_translated_at
+            FROM translations
+            GROUP BY sentence_id
+        ) t
+        WHERE ds.id = t.sentence_id;
+    """),
+    (13, "Эталоны только из ответов GPT", """
+        -- Переводы пользователей с высокой оценкой больше не считаются эталонами:
+        -- мелкая ошибка, которую пропустил GPT, иначе засчитывалась бы следующим как 100/100
+        DELETE FROM reference_translations WHERE source = 'user';
+    """),
+    (14, "Неудачные запросы новостей в news_fetches", """
+        -- Неудачный запрос тоже записывается: до retry_after остальные группы получают ту же ошибку,
+        -- а не идут во внешний API снова
+        ALTER TABLE news_fetches ADD COLUMN IF NOT EXISTS error TEXT;
+        ALTER TABLE news_fetches ADD COLUMN IF NOT EXISTS retry_after TIMESTAMPTZ;
+    """),
+]
+
+MIGRATIONS_LOCK_ID = 7_318_001  # Ключ advisory-блокировки: две копии бота не мигрируют одновременно
+
+
+async def apply_migrations():
+    """Применяет все ещё не применённые миграции одной транзакцией."""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            """)
+            await cursor.execute("SELECT version FROM schema_migrations;")
+            applied = {row[0] for row in await cursor.fetchall()}
+
+            for version, name, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                await cursor.execute(sql)
+                await cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                    (version, name)
                 )
+                print(f"✅ Миграция {version} применена: {name}")
+
+    print(f"✅ Схема базы данных актуальна (версия {MIGRATIONS[-1][0]}).")
+
+
+
+# === Помесячные партиции messages и translations ===
+# Обе таблицы разбиты на партиции по месяцам (миграция 9). Задача maintain_partitions раз в день
+# создаёт партиции на PARTITION_MONTHS_AHEAD месяцев вперёд и убирает партиции старше срока хранения:
+# отсоединяет их в схему archive (PARTITION_RETENTION_MODE=detach, можно выгрузить и удалить вручную)
+# или удаляет сразу (drop). Срок 0 — хранить всё.
+# ⚠️ /rebuildstats считает агрегаты по translations, поэтому для переводов срок по умолчанию не ограничен.
+PARTITION_MONTHS_AHEAD = 2
+MESSAGES_RETENTION_MONTHS = int(os.getenv("MESSAGES_RETENTION_MONTHS", "12"))
+TRANSLATIONS_RETENTION_MONTHS = int(os.getenv("TRANSLATIONS_RETENTION_MONTHS", "0"))
+PARTITION_RETENTION_MODE = os.getenv("PARTITION_RETENTION_MODE", "detach").strip().lower()
+
+if PARTITION_RETENTION_MODE not in ("detach", "drop"):
+    raise ValueError(f"❌ Ошибка: неизвестный PARTITION_RETENTION_MODE={PARTITION_RETENTION_MODE!r}. Допустимо: detach, drop.")
+
+
+@instrumented
+async def maintain_partitions(context: CallbackContext = None):
+    """Создаёт партиции на ближайшие месяцы и убирает партиции старше срока хранения."""
+    retired = []
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            for table, retention_months in (("messages", MESSAGES_RETENTION_MONTHS), ("translations", TRANSLATIONS_RETENTION_MONTHS)):
+                for months_ahead in range(PARTITION_MONTHS_AHEAD + 1):
+                    await cursor.execute(
+                        "SELECT create_monthly_partition(%s, (date_trunc('month', CURRENT_DATE) + make_interval(months => %s))::date);",
+                        (table, months_ahead)
+                    )
+
+                if retention_months <= 0:
+                    continue
+
+                # Месяц партиции берём из её имени (parent_yYYYYmMM); DEFAULT-партицию не трогаем
+                await cursor.execute("""
+                    SELECT child.relname
+                    FROM pg_inherits
+                    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                    WHERE pg_inherits.inhparent = %s::regclass
+                      AND child.relname ~ '_y[0-9]{4}m[0-9]{2}$'
+                      AND to_date(right(child.relname, 7), 'YYYY"m"MM')
+                          < date_trunc('month', CURRENT_DATE) - make_interval(months => %s)
+                    ORDER BY child.relname;
+                """, (table, retention_months))
+
+                for (partition,) in await cursor.fetchall():
+                    if PARTITION_RETENTION_MODE == "drop":
+                        await cursor.execute(psycopg.sql.SQL("DROP TABLE {};").format(psycopg.sql.Identifier(partition)))
+                    else:
+                        await cursor.execute(psycopg.sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(
+                            psycopg.sql.Identifier(table), psycopg.sql.Identifier(partition)))
+                        await cursor.execute(psycopg.sql.SQL("ALTER TABLE {} SET SCHEMA archive;").format(
+                            psycopg.sql.Identifier(partition)))
+                    retired.append(partition)
+
+    if retired:
+        action = "удалены" if PARTITION_RETENTION_MODE == "drop" else "перенесены в схему archive"
+        logging.info(f"🗄 Старые партиции {action}: {', '.join(retired)}")
+
+
+
+
+
+# === Агрегаты статистики: user_daily_stats ===
+# Отчёты и /stats читают готовые суммы за день вместо пересчёта по сырым таблицам.
+# Таблица обновляется инкрементально в тех же транзакциях, что и сырые данные:
+# при выдаче предложений, при сохранении проверенных переводов и при закрытии сессий.
+# /rebuildstats пересобирает её целиком из daily_sentences, translations и user_progress.
+
+async def add_assigned_stats(cursor, chat_id, user_id, username, count):
+    """Учитывает `count` выданных сегодня предложений."""
+    await cursor.execute("""
+        INSERT INTO user_daily_stats (chat_id, user_id, date, username, assigned)
+        VALUES (%s, %s, CURRENT_DATE, %s, %s)
+        ON CONFLICT (chat_id, user_id, date) DO UPDATE
+        SET assigned = user_daily_stats.assigned + EXCLUDED.assigned,
+            username = COALESCE(EXCLUDED.username, user_daily_stats.username);
+    """, (chat_id, user_id, username, count))
+
+
+async def add_translation_stats(cursor, chat_id, user_id, username, date, scores):
+    """Учитывает проверенные переводы предложений, выданных в день `date` (scores — оценки, None без оценки)."""
+    valid_scores = [score for score in scores if score is not None]
+    await cursor.execute("""
+        INSERT INTO user_daily_stats (chat_id, user_id, date, username, translated, score_sum, scored)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (chat_id, user_id, date) DO UPDATE
+        SET translated = user_daily_stats.translated + EXCLUDED.translated,
+            score_sum = user_daily_stats.score_sum + EXCLUDED.score_sum,
+            scored = user_daily_stats.scored + EXCLUDED.scored,
+            username = COALESCE(user_daily_stats.username, EXCLUDED.username);
+    """, (chat_id, user_id, date, username, len(scores), sum(valid_scores), len(valid_scores)))
+
+
+async def close_sessions(cursor, condition, params=()):
+    """Закрывает открытые сессии, подходящие под `condition`, и добавляет их время в user_daily_stats.
+
+    `condition` — фиксированный SQL-фрагмент из кода бота (не пользовательский ввод).
+    """
+    await cursor.execute(f"""
+        WITH closed AS (
+            UPDATE user_progress
+            SET end_time = NOW(), completed = TRUE
+            WHERE completed = FALSE AND {condition}
+            RETURNING chat_id, user_id, username, start_time::date AS date,
+                EXTRACT(EPOCH FROM (end_time - start_time)) / 60 AS minutes
+        )
+        INSERT INTO user_daily_stats (chat_id, user_id, date, username, sessions, session_minutes)
+        SELECT chat_id, user_id, date, MAX(username), COUNT(*), SUM(minutes)
+        FROM closed
+        WHERE user_id IS NOT NULL
+        GROUP BY chat_id, user_id, date
+        ON CONFLICT (chat_id, user_id, date) DO UPDATE
+        SET sessions = user_daily_stats.sessions + EXCLUDED.sessions,
+            session_minutes = user_daily_stats.session_minutes + EXCLUDED.session_minutes,
+            username = COALESCE(user_daily_stats.username, EXCLUDED.username);
+    """, params)
+
+
+REBUILD_USER_DAILY_STATS_SQL = """
+        INSERT INTO user_daily_stats (chat_id, user_id, date, username, assigned, translated, score_sum, scored, sessions, session_minutes)
+        SELECT
+            COALESCE(a.chat_id, s.chat_id),
+            COALESCE(a.user_id, s.user_id),
+            COALESCE(a.date, s.date),
+            COALESCE(s.username, a.username,
+                (SELECT MAX(up.username) FROM user_progress up WHERE up.user_id = COALESCE(a.user_id, s.user_id))),
+            COALESCE(a.assigned, 0),
+            COALESCE(a.translated, 0),
+            COALESCE(a.score_sum, 0),
+            COALESCE(a.scored, 0),
+            COALESCE(s.sessions, 0),
+            COALESCE(s.session_minutes, 0)
+        FROM (
+            -- Выданные предложения и переводы к ним (по дате выдачи предложения)
+            SELECT ds.chat_id, ds.user_id, ds.date, MAX(t.username) AS username,
+                COUNT(DISTINCT ds.id) AS assigned,
+                COUNT(DISTINCT t.id) AS translated,
+                COALESCE(SUM(t.score), 0) AS score_sum,
+                COUNT(t.score) AS scored
+            FROM daily_sentences ds
+            LEFT JOIN translations t ON t.user_id = ds.user_id AND t.sentence_id = ds.id
+            WHERE ds.user_id IS NOT NULL
+            GROUP BY ds.chat_id, ds.user_id, ds.date
+        ) a
+        FULL JOIN (
+            -- Завершённые сессии (по дате начала)
+            SELECT chat_id, user_id, start_time::date AS date, MAX(username) AS username,
+                COUNT(*) AS sessions,
+                SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60) AS session_minutes
+            FROM user_progress
+            WHERE completed = TRUE AND end_time IS NOT NULL AND user_id IS NOT NULL
+            GROUP BY chat_id, user_id, start_time::date
+        ) s ON s.chat_id = a.chat_id AND s.user_id = a.user_id AND s.date = a.date;
+"""
+
+
+async def rebuild_user_daily_stats():
+    """Пересобирает user_daily_stats из сырых таблиц. Возвращает число строк."""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # Блокировка не даёт инкрементальным обновлениям вклиниться между очисткой и пересчётом
+            await cursor.execute("LOCK TABLE user_daily_stats IN EXCLUSIVE MODE;")
+            await cursor.execute("DELETE FROM user_daily_stats;")
+            await cursor.execute(REBUILD_USER_DAILY_STATS_SQL)
+            return cursor.rowcount
+
+
+
+
+
+# === Группы (несколько учебных групп в одном процессе бота) ===
+# Все данные (предложения, переводы, сессии, сообщения, агрегаты) хранятся с chat_id группы,
+# отчёты считаются по каждой группе отдельно. Задачи по расписанию обходят активные группы
+# параллельно (не больше GROUP_JOB_CONCURRENCY сразу): медленная или упавшая группа не задерживает остальные.
+known_chat_groups = set()  # Группы, уже записанные в chat_groups этим процессом
+
+
+async def register_chat_group(chat):
+    """Добавляет группу в chat_groups при первом сообщении из неё (один запрос на группу за время работы процесса)."""
+    if chat.id in known_chat_groups:
+        return
+    async with get_db_connection() as conn:
+        await conn.execute("""
+            INSERT INTO chat_groups (chat_id, title) VALUES (%s, %s)
+            ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title;
+        """, (chat.id, chat.title))
+    known_chat_groups.add(chat.id)
+
+
+async def resolve_chat_id(update: Update):
+    """Группа, к которой относится команда: сам чат, а для лички — группа, где пользователь был активен последним."""
+    chat = update.effective_chat
+    if chat.type in (chat.GROUP, chat.SUPERGROUP):
+        await register_chat_group(chat)
+        return chat.id
+
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("""
+            SELECT chat_id FROM user_daily_stats
+            WHERE user_id = %s
+            ORDER BY date DESC
+            LIMIT 1;
+        """, (update.effective_user.id,))
+        row = await cursor.fetchone()
+    return row[0] if row else GROUP_CHAT_ID
+
+
+async def get_group_ids(condition="TRUE", params=()):
+    """Активные группы, подходящие под `condition` (фиксированный SQL-фрагмент из кода бота)."""
+    async with get_db_connection() as conn:
+        cursor = await conn.execute(
+            f"SELECT chat_id FROM chat_groups WHERE active AND {condition} ORDER BY chat_id;", params
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+
+def per_group(job, condition="TRUE", params=tuple):
+    """Превращает задачу для одной группы `job(context, chat_id)` в задачу JobQueue для всех активных групп.
+
+    `params` — функция, возвращающая параметры для `condition` в момент запуска.
+    """
+    @functools.wraps(job)
+    async def run_for_groups(context: CallbackContext):
+        chat_ids = await get_group_ids(condition, params())
+        semaphore = asyncio.Semaphore(GROUP_JOB_CONCURRENCY)
+
+        async def run(chat_id):
+            async with semaphore:
+                try:
+                    await job(context, chat_id)
+                except Exception as e:
+                    logging.error(f"❌ {job.__name__}: ошибка для группы {chat_id}: {e!r}")
+
+        await asyncio.gather(*(run(chat_id) for chat_id in chat_ids))
+
+    return run_for_groups
+
+
+
+
+
+# === Очередь исходящих сообщений ===
+# Всё, что бот отправляет пачками (отчёты, новости, результаты проверки), идёт через очередь:
+# у каждого чата своя очередь и свой token bucket (в группе Telegram разрешает ~20 сообщений в минуту,
+# в личке ~1 в секунду), плюс общий bucket на весь бот (~30 в секунду).
+# Подряд идущие короткие сообщения в один чат склеиваются в одно, RetryAfter выжидается автоматически.
+TELEGRAM_MAX_MESSAGE_LENGTH = 4000  # Чтобы не рисковать, оставляем небольшой запас до лимита 4096
+OUTBOUND_GLOBAL_PER_SECOND = float(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", "25"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_PRIVATE_PER_SECOND = float(os.getenv("OUTBOUND_PRIVATE_PER_SECOND", "1"))
+OUTBOUND_COALESCE_MAX_LENGTH = int(os.getenv("OUTBOUND_COALESCE_MAX_LENGTH", "1000"))  # Какие сообщения считаются короткими
+OUTBOUND_MAX_RETRIES = 5
+OUTBOUND_SHUTDOWN_TIMEOUT = 10
+
+
+class TokenBucket:
+    """Token bucket: `rate` токенов в секунду, не больше `capacity` про запас."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)  # Больше ёмкости ждать бессмысленно: пропускаем, когда bucket полон
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.blocked_until and self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep(max(self.blocked_until - now, (amount - self.tokens) / self.rate))
+
+    def adjust(self, amount):
+        """Списывает (или возвращает, если amount < 0) токены задним числом, например по фактическому расходу."""
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def block(self, seconds):
+        """Запрещает отправку на `seconds` секунд (после RetryAfter от Telegram)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class OutboundMessage:
+    __slots__ = ("bot", "text", "kwargs", "coalesce", "edit_message_id", "future", "enqueued_at")
+
+    def __init__(self, bot, text, kwargs, coalesce, edit_message_id=None):
+        self.bot = bot
+        self.text = text
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.edit_message_id = edit_message_id  # Не None — это правка уже отправленного сообщения
+        self.future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(log_outbound_failure)
+        self.enqueued_at = time.monotonic()
+
+
+outbound_queues = {}  # chat_id -> deque[OutboundMessage]
+outbound_workers = {}  # chat_id -> задача, которая разбирает очередь чата
+outbound_buckets = {}  # chat_id -> TokenBucket
+outbound_global_bucket = TokenBucket(OUTBOUND_GLOBAL_PER_SECOND, OUTBOUND_GLOBAL_PER_SECOND)
+outbound_latencies = deque(maxlen=1000)  # Секунды от постановки в очередь до отправки
+outbound_stats = {"queued": 0, "sent": 0, "coalesced": 0, "retry_after": 0, "failed": 0}
+
+
+def log_outbound_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"❌ Не удалось отправить сообщение: {future.exception()}")
+
+
+def split_message(text, limit=TELEGRAM_MAX_MESSAGE_LENGTH):
+    """Разбивает длинный текст на части не длиннее `limit`, по возможности по переносу строки."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+def get_chat_bucket(chat_id):
+    bucket = outbound_buckets.get(chat_id)
+    if bucket is None:
+        if chat_id < 0:  # Группы и каналы
+            bucket = TokenBucket(OUTBOUND_GROUP_PER_MINUTE / 60, 3)
         else:
-            await context.bot.send_message(chat_id=GROUP_CHAT_ID, text="❌ Нет свежих новостей на сегодня!")
+            bucket = TokenBucket(OUTBOUND_PRIVATE_PER_SECOND, 1)
+        outbound_buckets[chat_id] = bucket
+    return bucket
+
+
+def enqueue_message(bot, chat_id, text, coalesce=True, **kwargs):
+    """Ставит сообщение в очередь отправки и сразу возвращает future с отправленным Message.
+
+    Длинный текст разбивается на части (future — последней части), пустой не отправляется (future сразу с None).
+    `kwargs` передаются в send_message.
+    С coalesce=True сообщение может быть склеено с соседними короткими сообщениями в тот же чат
+    с теми же параметрами; если нужен именно свой Message (например, чтобы потом его редактировать),
+    передайте coalesce=False.
+    """
+    parts = split_message(text)
+    if not parts:
+        # Пустой текст Telegram всё равно отклонит — ничего не отправляем
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    queue = outbound_queues.setdefault(chat_id, deque())
+    for part in parts:
+        message = OutboundMessage(bot, part, kwargs, coalesce)
+        queue.append(message)
+        outbound_stats["queued"] += 1
+
+    ensure_outbound_worker(chat_id)
+    return message.future
+
+
+def enqueue_edit(bot, chat_id, message_id, text, **kwargs):
+    """Ставит в очередь правку отправленного сообщения (текст не длиннее TELEGRAM_MAX_MESSAGE_LENGTH).
+
+    Если правка того же сообщения ещё ждёт отправки, она просто получает новый текст:
+    частые обновления схлопываются в одно и не тратят лимит Telegram.
+    """
+    queue = outbound_queues.setdefault(chat_id, deque())
+    for pending in queue:
+        if pending.edit_message_id == message_id:
+            pending.text, pending.kwargs = text, kwargs
+            return pending.future
+
+    message = OutboundMessage(bot, text, kwargs, coalesce=False, edit_message_id=message_id)
+    queue.append(message)
+    outbound_stats["queued"] += 1
+    ensure_outbound_worker(chat_id)
+    return message.future
+
+
+def ensure_outbound_worker(chat_id):
+    if chat_id not in outbound_workers:
+        outbound_workers[chat_id] = asyncio.create_task(outbound_worker(chat_id))
+
+
+def reply_queued(update: Update, text, **kwargs):
+    """Ответ на сообщение через очередь; как reply_text, в группе отвечает цитатой."""
+    message = update.message
+    if message.chat.type != "private":
+        kwargs.setdefault("reply_to_message_id", message.message_id)
+    return enqueue_message(message.get_bot(), message.chat_id, text, **kwargs)
+
+
+def can_coalesce(batch, candidate):
+    first = batch[0]
+    length = sum(len(m.text) + 2 for m in batch) + len(candidate.text)
+    return (
+        first.coalesce and candidate.coalesce
+        and candidate.bot is first.bot and candidate.kwargs == first.kwargs
+        and len(candidate.text) <= OUTBOUND_COALESCE_MAX_LENGTH
+        and all(len(m.text) <= OUTBOUND_COALESCE_MAX_LENGTH for m in batch)
+        and length <= TELEGRAM_MAX_MESSAGE_LENGTH
+    )
+
+
+async def outbound_worker(chat_id):
+    """Разбирает очередь одного чата по порядку; завершается, когда очередь пуста."""
+    queue = outbound_queues[chat_id]
+    try:
+        while queue:
+            batch = [queue.popleft()]
+            while queue and can_coalesce(batch, queue[0]):
+                batch.append(queue.popleft())
+            outbound_stats["coalesced"] += len(batch) - 1
+            await deliver_outbound(chat_id, batch)
+    finally:
+        outbound_workers.pop(chat_id, None)
+
+
+async def deliver_outbound(chat_id, batch):
+    first = batch[0]
+    text = "\n\n".join(m.text for m in batch)
+    bucket = get_chat_bucket(chat_id)
+    error = None
+    for attempt in range(OUTBOUND_MAX_RETRIES):
+        await bucket.acquire()
+        await outbound_global_bucket.acquire()
+        started = time.perf_counter()
+        try:
+            if first.edit_message_id is not None:
+                sent = await first.bot.edit_message_text(
+                    text=text, chat_id=chat_id, message_id=first.edit_message_id, **first.kwargs
+                )
+            else:
+                sent = await first.bot.send_message(chat_id=chat_id, text=text, **first.kwargs)
+            TELEGRAM_SEND_SECONDS.labels("ok").observe(time.perf_counter() - started)
+        except BadRequest as e:
+            if first.edit_message_id is None or "not modified" not in str(e).lower():
+                TELEGRAM_SEND_SECONDS.labels("error").observe(time.perf_counter() - started)
+                error = e
+                break
+            sent = None  # Текст не изменился — правка не нужна, это не ошибка
+        except RetryAfter as e:
+            TELEGRAM_SEND_SECONDS.labels("retry_after").observe(time.perf_counter() - started)
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            outbound_stats["retry_after"] += 1
+            logging.warning(f"⏳ Telegram просит подождать {retry_after} с перед отправкой в чат {chat_id}")
+            bucket.block(retry_after)
+            error = e
+            continue
+        except Exception as e:
+            TELEGRAM_SEND_SECONDS.labels("error").observe(time.perf_counter() - started)
+            error = e
+            break
+
+        now = time.monotonic()
+        outbound_stats["sent"] += 1
+        for m in batch:
+            outbound_latencies.append(now - m.enqueued_at)
+            OUTBOUND_WAIT_SECONDS.observe(now - m.enqueued_at)
+            if not m.future.done():
+                m.future.set_result(sent)
+        return
+
+    outbound_stats["failed"] += len(batch)
+    for m in batch:
+        if not m.future.done():
+            m.future.set_exception(error)
+
+
+def outbound_queue_depth():
+    return sum(len(queue) for queue in outbound_queues.values())
+
+
+Gauge("bot_outbound_queue_depth", "Сообщений в очереди отправки").set_function(outbound_queue_depth)
+
+
+def outbound_latency_percentile(percent):
+    if not outbound_latencies:
+        return 0.0
+    ordered = sorted(outbound_latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+async def drain_outbound_queue():
+    """При остановке бота даёт очереди отправиться (не дольше OUTBOUND_SHUTDOWN_TIMEOUT секунд)."""
+    workers = list(outbound_workers.values())
+    if not workers:
+        return
+    done, pending = await asyncio.wait(workers, timeout=OUTBOUND_SHUTDOWN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"⚠️ При остановке не отправлено сообщений: {outbound_queue_depth()}")
+
+
+
+# === Новости на немецком ===
+# Запрос к новостному API идёт через общий асинхронный HTTP-клиент с таймаутами и повторами.
+# Полученные статьи сохраняются в news_articles (без дублей по url), а факт запроса за день —
+# в news_fetches: повторный запуск задачи в тот же день не ходит во внешний API.
+# Неудачный запрос записывается туда же с ошибкой: NEWS_FAILURE_BACKOFF_MINUTES остальные группы
+# получают ту же ошибку без обращения к API, потом запрос повторяется.
+# NEWS_API_URL можно направить на локальную заглушку для тестов.
+NEWS_API_URL = os.getenv("NEWS_API_URL", "http://api.mediastack.com/v1/news")
+NEWS_API_PARAMS = {"languages": "de", "countries": "de,au", "limit": 2}  # Ограничим до 2 новостей
+#NEWS_API_PARAMS = {"languages": "de", "countries": "at", "limit": 3}  for Austria
+NEWS_CONNECT_TIMEOUT = float(os.getenv("NEWS_CONNECT_TIMEOUT", "5"))
+NEWS_READ_TIMEOUT = float(os.getenv("NEWS_READ_TIMEOUT", "10"))
+NEWS_MAX_RETRIES = int(os.getenv("NEWS_MAX_RETRIES", "3"))
+NEWS_FAILURE_BACKOFF_MINUTES = int(os.getenv("NEWS_FAILURE_BACKOFF_MINUTES", "30"))
+
+news_http_client = None  # httpx.AsyncClient, создаётся при первом запросе
+news_lock = None  # Одновременные запуски ждут один запрос к API
+
+
+class NewsFetchError(Exception):
+    pass
+
+
+def get_news_http_client():
+    global news_http_client
+    if news_http_client is None:
+        news_http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(NEWS_READ_TIMEOUT, connect=NEWS_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=5, max_keepalive_connections=2),
+        )
+    return news_http_client
+
+
+async def close_news_http_client():
+    global news_http_client
+    if news_http_client is not None:
+        await news_http_client.aclose()
+        news_http_client = None
+
+
+async def fetch_news_from_api():
+    """Запрашивает свежие статьи у API. Сетевые ошибки, 429 и 5xx повторяются с экспоненциальной задержкой и jitter."""
+    params = {"access_key": API_KEY_NEWS, **NEWS_API_PARAMS}
+    for attempt in range(1, NEWS_MAX_RETRIES + 1):
+        try:
+            response = await get_news_http_client().get(NEWS_API_URL, params=params)
+        except httpx.TransportError as e:
+            error = f"{type(e).__name__}: {e}"
+        else:
+            if response.status_code == 200:
+                return response.json().get("data") or []
+            error = f"{response.status_code} - {response.text[:300]}"
+            if response.status_code != 429 and response.status_code < 500:
+                raise NewsFetchError(error)  # Ошибка запроса (ключ, параметры): повтор не поможет
+
+        logging.warning(f"⚠️ Новостной API: {error} (попытка {attempt}/{NEWS_MAX_RETRIES})")
+        if attempt < NEWS_MAX_RETRIES:
+            await asyncio.sleep(random.uniform(0, 2 ** attempt))
+    raise NewsFetchError(error)
+
+
+async def get_todays_news():
+    """Возвращает статьи, впервые полученные сегодня.
+
+    Удачный запрос к внешнему API — не больше одного в день; после неудачи следующий
+    не раньше чем через NEWS_FAILURE_BACKOFF_MINUTES (до тех пор бросает ту же NewsFetchError).
+    """
+    global news_lock
+    if news_lock is None:
+        news_lock = asyncio.Lock()
+
+    async with news_lock:
+        async with get_db_connection() as conn:
+            cursor = await conn.execute("""
+                SELECT error, retry_after > CURRENT_TIMESTAMP FROM news_fetches WHERE date = CURRENT_DATE;
+            """)
+            fetch = await cursor.fetchone()
+
+        if fetch is not None and fetch[0] is not None and fetch[1]:
+            raise NewsFetchError(fetch[0])  # Недавний запрос не удался — не повторяем его для каждой группы
+
+        if fetch is None or fetch[0] is not None:
+            try:
+                articles = await fetch_news_from_api()
+            except NewsFetchError as e:
+                async with get_db_connection() as conn:
+                    await conn.execute("""
+                        INSERT INTO news_fetches (date, articles, error, retry_after)
+                        VALUES (CURRENT_DATE, 0, %s, CURRENT_TIMESTAMP + make_interval(mins => %s))
+                        ON CONFLICT (date) DO UPDATE
+                        SET fetched_at = CURRENT_TIMESTAMP, error = EXCLUDED.error, retry_after = EXCLUDED.retry_after;
+                    """, (str(e), NEWS_FAILURE_BACKOFF_MINUTES))
+                raise
+
+            rows = [
+                (article.get("url"), article.get("title") or "Без заголовка", article.get("source"), article.get("published_at"))
+                for article in articles if article.get("url")
+            ]
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.executemany("""
+                        INSERT INTO news_articles (url, title, source, published_at)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (url) DO NOTHING;
+                    """, rows)
+                    await cursor.execute("""
+                        INSERT INTO news_fetches (date, articles) VALUES (CURRENT_DATE, %s)
+                        ON CONFLICT (date) DO UPDATE
+                        SET fetched_at = CURRENT_TIMESTAMP, articles = EXCLUDED.articles, error = NULL, retry_after = NULL;
+                    """, (len(rows),))
+
+        async with get_db_connection() as conn:
+            cursor = await conn.execute("""
+                SELECT title, source, url FROM news_articles
+                WHERE first_seen = CURRENT_DATE
+                ORDER BY id;
+            """)
+            return await cursor.fetchall()
+
+
+# Функция для получения новостей на немецком
+@instrumented
+async def send_german_news(context: CallbackContext, chat_id):
+    try:
+        articles = await get_todays_news()
+    except NewsFetchError as e:
+        enqueue_message(context.bot, chat_id, f"❌ Ошибка: {e}")
+        return
+
+    if articles:
+        print("📢 Nachrichten auf Deutsch:")
+        for i, (title, source, url) in enumerate(articles, start=1):
+            message = f"📰 {i}. *{title}*\n\n📌 {source or 'Неизвестный источник'}\n\n[Читать полностью]({url})"
+            # coalesce=False: у каждой статьи своё сообщение со своим превью
+            enqueue_message(
+                context.bot, chat_id, message,
+                coalesce=False,
+                parse_mode="Markdown",
+                disable_web_page_preview=False  # Чтобы загружались превью страниц
+            )
     else:
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=f"❌ Ошибка: {response.status_code} - {response.text}")
+        enqueue_message(context.bot, chat_id, "❌ Нет свежих новостей на сегодня!")
 
 
 
@@ -175,31 +1411,155 @@ logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 
 
+# === Буферизованная запись сообщений чата ===
+# log_message срабатывает на каждое сообщение в группе, поэтому не ходит в базу сам:
+# сообщение кладётся в ограниченную очередь, а фоновая задача пишет их пачками через COPY
+# каждые MESSAGE_BATCH_SIZE сообщений или MESSAGE_FLUSH_INTERVAL_MS миллисекунд.
+# Если база не успевает и очередь заполнена, обработчик ждёт свободного места (backpressure).
+# Вместе с пачкой обновляются chat_members_activity и chat_member_months — по ним отчёты ищут ленивцев.
+# STORE_MESSAGE_TEXT=0 — сами тексты в messages не сохраняются, учитывается только активность.
+STORE_MESSAGE_TEXT = os.getenv("STORE_MESSAGE_TEXT", "1") == "1"
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "1000"))
+MESSAGE_QUEUE_MAX_SIZE = int(os.getenv("MESSAGE_QUEUE_MAX_SIZE", "10000"))
+MESSAGE_FLUSH_RETRIES = 3
+
+message_queue = None  # asyncio.Queue, создаётся в start_message_writer (привязана к циклу событий)
+message_writer_task = None
+_MESSAGE_QUEUE_STOP = object()  # Сигнал писателю: сбросить остаток и завершиться
+
+
+async def write_messages(rows):
+    """Записывает пачку сообщений одним COPY и обновляет активность участников (одна транзакция)."""
+    chat_ids, user_ids, usernames, _, timestamps = zip(*rows)
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            if STORE_MESSAGE_TEXT:
+                async with cursor.copy("COPY messages (chat_id, user_id, username, message, timestamp) FROM STDIN") as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+
+            # Вся пачка — одним запросом: месячные счётчики и последнее имя / время каждого участника
+            await cursor.execute("""
+                WITH batch AS (
+                    SELECT * FROM unnest(%s::BIGINT[], %s::BIGINT[], %s::TEXT[], %s::TIMESTAMPTZ[])
+                        AS batch (chat_id, user_id, username, ts)
+                ),
+                months AS (
+                    INSERT INTO chat_member_months (chat_id, month, user_id, messages)
+                    SELECT chat_id, date_trunc('month', ts)::date, user_id, COUNT(*)
+                    FROM batch
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT (chat_id, month, user_id) DO UPDATE
+                    SET messages = chat_member_months.messages + EXCLUDED.messages
+                )
+                INSERT INTO chat_members_activity (chat_id, user_id, username, first_seen, last_seen)
+                SELECT DISTINCT ON (chat_id, user_id) chat_id, user_id, username,
+                    MIN(ts) OVER (PARTITION BY chat_id, user_id), ts
+                FROM batch
+                ORDER BY chat_id, user_id, ts DESC
+                ON CONFLICT (chat_id, user_id) DO UPDATE
+                SET username = CASE WHEN EXCLUDED.last_seen >= chat_members_activity.last_seen
+                                    THEN EXCLUDED.username ELSE chat_members_activity.username END,
+                    last_seen = GREATEST(chat_members_activity.last_seen, EXCLUDED.last_seen);
+            """, (list(chat_ids), list(user_ids), list(usernames), list(timestamps)))
+
+
+async def flush_messages(rows):
+    """Сбрасывает пачку в базу, повторяя при ошибках. После MESSAGE_FLUSH_RETRIES попыток пачка теряется."""
+    for attempt in range(1, MESSAGE_FLUSH_RETRIES + 1):
+        try:
+            await write_messages(rows)
+            return
+        except Exception as e:
+            logging.error(f"❌ Ошибка записи {len(rows)} сообщений (попытка {attempt}/{MESSAGE_FLUSH_RETRIES}): {e}")
+            if attempt < MESSAGE_FLUSH_RETRIES:
+                await asyncio.sleep(attempt)
+    logging.error(f"❌ Пачка из {len(rows)} сообщений не записана и отброшена.")
+
+
+async def message_writer():
+    """Фоновая задача: собирает сообщения из очереди в пачки и пишет их в базу."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await message_queue.get()
+        if item is _MESSAGE_QUEUE_STOP:
+            break
+        rows = [item]
+        deadline = loop.time() + MESSAGE_FLUSH_INTERVAL_MS / 1000
+
+        # 🔹 Добираем пачку, пока не наберётся MESSAGE_BATCH_SIZE или не выйдет время
+        while len(rows) < MESSAGE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(message_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _MESSAGE_QUEUE_STOP:
+                stopping = True
+                break
+            rows.append(item)
+
+        await flush_messages(rows)
+
+    # 🔹 Всё, что попало в очередь после сигнала остановки, тоже сохраняем
+    rows = [item for item in iter_nowait(message_queue) if item is not _MESSAGE_QUEUE_STOP]
+    for start in range(0, len(rows), MESSAGE_BATCH_SIZE):
+        await flush_messages(rows[start:start + MESSAGE_BATCH_SIZE])
+
+
+def iter_nowait(queue):
+    """Забирает из очереди всё, что в ней есть сейчас, не дожидаясь новых элементов."""
+    while True:
+        try:
+            yield queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+
+def start_message_writer():
+    global message_queue, message_writer_task
+    message_queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_MAX_SIZE)
+    message_writer_task = asyncio.create_task(message_writer())
+
+
+async def stop_message_writer():
+    """Сбрасывает в базу все накопленные сообщения и останавливает писателя (вызывается при остановке бота)."""
+    global message_writer_task
+    if message_writer_task is None:
+        return
+    await message_queue.put(_MESSAGE_QUEUE_STOP)
+    await message_writer_task
+    message_writer_task = None
+    print("✅ Очередь сообщений сброшена в базу.")
+
+
+@instrumented
 async def log_message(update: Update, context: CallbackContext):
-    """Логирует все сообщения в базе данных"""
+    """Логирует все сообщения в базе данных (через очередь, без похода в базу на каждое сообщение)"""
     
     if not update.message:  # Если update.message = None, просто игнорируем
         return  
 
     user = update.message.from_user
+    chat = update.effective_chat
     message_text = update.message.text.strip()
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # 🔹 Новая группа появляется в chat_groups с первым же сообщением
+    if chat.type in (chat.GROUP, chat.SUPERGROUP):
+        await register_chat_group(chat)
 
-    cursor.execute(
-        "INSERT INTO messages (user_id, username, message) VALUES (%s, %s, %s);",
-        (user.id, user.username or user.first_name, message_text)
-    )
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    # 🔹 Время фиксируем сейчас, а не в момент записи пачки
+    await message_queue.put((chat.id, user.id, user.username or user.first_name, message_text, update.message.date))
 
 
 
 
-async def send_morning_reminder(context: CallbackContext):
+@instrumented
+async def send_morning_reminder(context: CallbackContext, chat_id):
     message = (
         "🌅 **Доброе утро, всем кроме Кончиты!**\n\n"
         "Чтобы принять участие в переводе, напишите команду `/letsgo`. После этого вам будут высланы предложения.\n\n"
@@ -221,78 +1581,59 @@ async def send_morning_reminder(context: CallbackContext):
         "/stats - Узнать свою статистику\n"
     )
     
-    # Отправляем два отдельных сообщения
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=message)
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=commands)
+    # Отправляем два отдельных сообщения (coalesce=False — очередь не склеит их в одно)
+    enqueue_message(context.bot, chat_id, message, coalesce=False)
+    enqueue_message(context.bot, chat_id, commands, coalesce=False)
 
 
 
+@instrumented
 async def letsgo(update: Update, context: CallbackContext):
     user = update.message.from_user
     user_id = user.id
     username = user.username or user.first_name
+    chat_id = await resolve_chat_id(update)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 **Проверяем, есть ли у пользователя активная сессия за сегодня**
+            await cursor.execute("""
+                SELECT user_id FROM user_progress 
+                WHERE chat_id = %s AND user_id = %s AND start_time >= CURRENT_DATE AND start_time < CURRENT_DATE + 1 AND completed = FALSE;
+            """, (chat_id, user_id))
 
-    # 🔹 **Проверяем, есть ли у пользователя активная сессия за сегодня**
-    cursor.execute("""
-        SELECT user_id FROM user_progress 
-        WHERE user_id = %s AND start_time::date = CURRENT_DATE AND completed = FALSE;
-    """, (user_id,))
-    
-    active_session = cursor.fetchone()
+            active_session = await cursor.fetchone()
+
+            if active_session is None:
+                # ✅ **Автоматически завершаем незавершённые сессии предыдущих дней**
+                await close_sessions(cursor, "chat_id = %s AND user_id = %s AND start_time < CURRENT_DATE", (chat_id, user_id))
+
+                # ✅ **Создаём новую запись в `user_progress`, НЕ ЗАТИРАЯ старые сессии**
+                await cursor.execute("""
+                    INSERT INTO user_progress (chat_id, user_id, username, start_time, completed) 
+                    VALUES (%s, %s, %s, NOW(), FALSE);
+                """, (chat_id, user_id, username))
 
     if active_session is not None:
         await update.message.reply_text(
             "❌ Вы уже начали перевод! Завершите его перед повторным запуском. "
             "Если вы уже выполняли задания и хотите ещё, используйте '/getmore'."
         )
-        cursor.close()
-        conn.close()
         return
 
-    # ✅ **Автоматически завершаем незавершённые сессии предыдущих дней**
-    cursor.execute("""
-        UPDATE user_progress 
-        SET end_time = NOW(), completed = TRUE 
-        WHERE user_id = %s AND start_time::date < CURRENT_DATE AND completed = FALSE;
-    """, (user_id,))
-    conn.commit()
-
-    # ✅ **Создаём новую запись в `user_progress`, НЕ ЗАТИРАЯ старые сессии**
-    cursor.execute("""
-        INSERT INTO user_progress (user_id, username, start_time, completed) 
-        VALUES (%s, %s, NOW(), FALSE);
-    """, (user_id, username))
-    conn.commit()
-
     # ✅ **Выдаём новые предложения**
-    sentences = [s.strip() for s in await get_original_sentences() if s.strip()]
+    sentences = [s.strip() for s in await get_original_sentences(user_id) if s.strip()]
 
     if not sentences:
         await update.message.reply_text("❌ Ошибка: не удалось получить предложения. Попробуйте позже.")
-        cursor.close()
-        conn.close()
         return
 
-    # Определяем стартовый индекс (если пользователь делал `/getmore`)
-    cursor.execute("""
-        SELECT COUNT(*) FROM daily_sentences WHERE date = CURRENT_DATE AND user_id = %s;
-    """, (user_id,))
-    last_index = cursor.fetchone()[0]  
-
-    tasks = []
-    for i, sentence in enumerate(sentences, start=last_index + 1):  
-        cursor.execute("""
-            INSERT INTO daily_sentences (date, sentence, unique_id, user_id) 
-            VALUES (CURRENT_DATE, %s, %s, %s);
-        """, (sentence, i, user_id))
-        tasks.append(f"{i}. {sentence}")
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # Нумерация продолжается после уже выданных сегодня (если пользователь делал `/getmore`)
+            tasks = await assign_sentences(cursor, chat_id, user_id, sentences)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+            await add_assigned_stats(cursor, chat_id, user_id, username, len(tasks))
 
     logging.info(f"🚀 Пользователь {username} ({user_id}) начал перевод. Записано {len(tasks)} предложений.")
 
@@ -304,53 +1645,40 @@ async def letsgo(update: Update, context: CallbackContext):
     )
 
 
+@instrumented
 async def done(update: Update, context: CallbackContext):
     user = update.message.from_user
     user_id = user.id
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Проверяем, есть ли у пользователя активная сессия
-    cursor.execute("""
-        SELECT start_time, end_time, completed 
-        FROM user_progress 
-        WHERE user_id = %s AND completed = FALSE
-        ORDER BY start_time DESC 
-        LIMIT 1;
-    """, (user_id,))
-  
-    row = cursor.fetchone()
+    chat_id = await resolve_chat_id(update)
+
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 Проверяем, есть ли у пользователя активная сессия
+            await cursor.execute("""
+                SELECT start_time, end_time, completed 
+                FROM user_progress 
+                WHERE chat_id = %s AND user_id = %s AND completed = FALSE
+                ORDER BY start_time DESC 
+                LIMIT 1;
+            """, (chat_id, user_id))
+
+            row = await cursor.fetchone()
+
+            if row:
+                # ✅ Позволяем пользователю всегда завершать сессию вручную
+                await close_sessions(cursor, "chat_id = %s AND user_id = %s", (chat_id, user_id))
+
+                # 🔹 Проверяем, все ли предложения переведены
+                await cursor.execute("""
+                    SELECT assigned, translated FROM user_daily_stats
+                    WHERE chat_id = %s AND user_id = %s AND date = CURRENT_DATE;
+                """, (chat_id, user_id))
+                total_sentences, translated_count = await cursor.fetchone() or (0, 0)
 
     if not row:
         await update.message.reply_text("❌ У вас нет активных сессий! Используйте /letsgo, чтобы начать.")
-        cursor.close()
-        conn.close()
         return
 
-    start_time, end_time, completed = row
-
-    # ✅ Позволяем пользователю всегда завершать сессию вручную
-    cursor.execute("""
-        UPDATE user_progress 
-        SET end_time = NOW(), completed = TRUE 
-        WHERE user_id = %s AND completed = FALSE;
-    """, (user_id,))
-    conn.commit()
-
-    # 🔹 Проверяем, все ли предложения переведены
-    cursor.execute("""
-        SELECT COUNT(*) FROM daily_sentences 
-        WHERE date = CURRENT_DATE AND user_id = %s;
-    """, (user_id,))
-    total_sentences = cursor.fetchone()[0]
-
-    cursor.execute("""
-        SELECT COUNT(*) FROM translations 
-        WHERE user_id = %s AND timestamp::date = CURRENT_DATE;
-    """, (user_id,))
-    translated_count = cursor.fetchone()[0]
-
     if translated_count < total_sentences:
         await update.message.reply_text(
             f"⚠️ Вы перевели {translated_count} из {total_sentences} предложений.\n"
@@ -359,53 +1687,178 @@ async def done(update: Update, context: CallbackContext):
     else:
         await update.message.reply_text("✅ **Вы успешно завершили перевод! Все предложения переведены.**")
 
-    cursor.close()
-    conn.close()
 
+@instrumented
+async def force_finalize_sessions(context: CallbackContext, chat_id):
+    """Завершает ВСЕ незавершённые сессии группы только за сегодняшний день в 23:59."""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await close_sessions(cursor, "chat_id = %s AND start_time >= CURRENT_DATE AND start_time < CURRENT_DATE + 1", (chat_id,))
 
-async def force_finalize_sessions(context: CallbackContext = None):
-    """Завершает ВСЕ незавершённые сессии только за сегодняшний день в 23:59."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    enqueue_message(context.bot, chat_id, "🔔 **Все незавершённые сессии за сегодня автоматически закрыты!**")
 
-    cursor.execute("""
-        UPDATE user_progress 
-        SET end_time = NOW(), completed = TRUE
-        WHERE completed = FALSE AND start_time::date = CURRENT_DATE;
-    """)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
 
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text="🔔 **Все незавершённые сессии за сегодня автоматически закрыты!**")
 
+async def auto_finalize_sessions():
+    """Каждые 2 минуты проверяет незавершённые переводы и завершает их, если есть переводы."""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await close_sessions(cursor, """
+                (chat_id, user_id) IN (SELECT DISTINCT chat_id, user_id FROM translations WHERE timestamp >= CURRENT_DATE AND timestamp < CURRENT_DATE + 1)
+            """)
 
 
 
-async def auto_finalize_sessions():
-    """Каждые 2 минуты проверяет незавершённые переводы и завершает их, если есть переводы."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        UPDATE user_progress 
-        SET end_time = NOW(), completed = TRUE
-        WHERE completed = FALSE
-        AND user_id IN (SELECT DISTINCT user_id FROM translations WHERE timestamp::date = CURRENT_DATE);
-    """)
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
 
 
+# === Общий клиент OpenAI ===
+# Один AsyncOpenAI на весь бот (соединения переиспользуются) и одна точка вызова openai_chat:
+#   - бюджет запросов и токенов в минуту (OPENAI_RPM / OPENAI_TPM): лишние вызовы ждут своей очереди,
+#     а не получают 429 все разом, когда вся группа отправляет переводы в 10:00;
+#   - таймаут на каждый вызов;
+#   - повтор 429, 5xx, таймаутов и сетевых ошибок с экспоненциальной задержкой и jitter,
+#     с учётом заголовка retry-after;
+#   - circuit breaker: после OPENAI_BREAKER_THRESHOLD сбоев подряд вызовы OPENAI_BREAKER_COOLDOWN секунд
+#     сразу завершаются ошибкой, потом один пробный вызов решает, открывать ли поток снова.
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "300000"))
+OPENAI_COMPLETION_TOKENS_ESTIMATE = 400  # Оценка ответа до запроса; после ответа бюджет поправляется по usage
+OPENAI_BACKOFF_BASE = 1.0
+OPENAI_BACKOFF_MAX = 30.0
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+
+openai_client = None  # Создаётся при первом вызове
+openai_request_bucket = TokenBucket(OPENAI_RPM / 60, max(1.0, OPENAI_RPM / 6))  # Запас — 10 секунд
+openai_token_bucket = TokenBucket(OPENAI_TPM / 60, max(1.0, OPENAI_TPM / 6))
+openai_breaker = {"failures": 0, "open_until": 0.0, "probing": False}
+
+
+class OpenAIUnavailableError(openai.OpenAIError):
+    """OpenAI временно недоступен (circuit breaker открыт) — вызов не выполнялся."""
+
+
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        # Повторы делает openai_chat, поэтому встроенные повторы SDK выключены
+        openai_client = openai.AsyncOpenAI(api_key=openai.api_key, timeout=OPENAI_TIMEOUT, max_retries=0)
+    return openai_client
+
+
+async def close_openai_client():
+    global openai_client
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
+
+
+def openai_breaker_state():
+    if openai_breaker["open_until"] > time.monotonic():
+        return "open"
+    if openai_breaker["failures"] >= OPENAI_BREAKER_THRESHOLD:
+        return "half-open"
+    return "closed"
+
+
+def estimate_tokens(messages):
+    # Грубая оценка: ~3 символа на токен (кириллица дороже латиницы) плюс ожидаемый ответ
+    return sum(len(m["content"]) for m in messages) // 3 + OPENAI_COMPLETION_TOKENS_ESTIMATE
+
+
+def retry_after_seconds(error):
+    """Сколько секунд просит подождать сервер (заголовки retry-after-ms / retry-after), иначе None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def is_retryable(error):
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code >= 500 or error.status_code == 409)
+
+
+async def openai_chat(operation, messages, timeout=None, **kwargs):
+    """Вызывает chat.completions.create через общий клиент с бюджетом, повторами и circuit breaker.
+
+    `operation` — имя для метрик. Возвращает ответ API; если все попытки неудачны — бросает последнюю
+    ошибку (openai.OpenAIError), при открытом circuit breaker — OpenAIUnavailableError.
+    """
+    estimate = estimate_tokens(messages)
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        state = openai_breaker_state()
+        if state == "open" or (state == "half-open" and openai_breaker["probing"]):
+            OPENAI_SECONDS.labels(operation, "circuit_open").observe(0)
+            raise OpenAIUnavailableError("OpenAI временно недоступен, повторите позже")
+        probe = state == "half-open"
+        if probe:
+            openai_breaker["probing"] = True
+
+        try:
+            # Пробу освобождаем при любом исходе (отмена, не-OpenAI исключение), иначе breaker
+            # так и останется half-open с занятой пробой и будет отклонять все вызовы до перезапуска
+            try:
+                await openai_request_bucket.acquire()
+                await openai_token_bucket.acquire(estimate)
+                started = time.perf_counter()
+                response = await get_openai_client().chat.completions.create(
+                    messages=messages, timeout=timeout or OPENAI_TIMEOUT, **kwargs
+                )
+            finally:
+                if probe:
+                    openai_breaker["probing"] = False
+        except openai.OpenAIError as e:
+            retryable = is_retryable(e)
+            outcome = "rate_limited" if isinstance(e, openai.RateLimitError) else "error"
+            record_openai_call(operation, started, outcome)
+            if retryable and not isinstance(e, openai.RateLimitError):
+                # 429 означает, что сервис жив; счётчик сбоев растёт только от 5xx, таймаутов и сетевых ошибок
+                openai_breaker["failures"] += 1
+                if openai_breaker["failures"] >= OPENAI_BREAKER_THRESHOLD:
+                    openai_breaker["open_until"] = time.monotonic() + OPENAI_BREAKER_COOLDOWN
+                    logging.error(f"🚫 OpenAI: {openai_breaker['failures']} сбоев подряд, пауза {OPENAI_BREAKER_COOLDOWN:.0f} с")
+            if not retryable or attempt == OPENAI_MAX_RETRIES:
+                raise
+
+            delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+            retry_after = retry_after_seconds(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if isinstance(e, openai.RateLimitError):
+                openai_request_bucket.block(delay)  # Остальные вызовы тоже подождут
+            OPENAI_RETRIES.labels(operation, type(e).__name__).inc()
+            logging.warning(f"⚠️ OpenAI ({operation}): {type(e).__name__}, повтор через {delay:.1f} с (попытка {attempt + 1}/{OPENAI_MAX_RETRIES})")
+            await asyncio.sleep(delay)
+            continue
+
+        record_openai_call(operation, started, "ok", response)
+        openai_breaker.update(failures=0, open_until=0.0)
+        if response.usage is not None:
+            openai_token_bucket.adjust(response.usage.total_tokens - estimate)
+        return response
+
+
+Gauge("bot_openai_circuit_open", "1, если circuit breaker OpenAI открыт").set_function(
+    lambda: 1 if openai_breaker_state() == "open" else 0
+)
 
 
 
 # === Функция для генерации новых предложений с помощью GPT-4 ===
 async def generate_sentences():
-    client = openai.AsyncOpenAI(api_key=openai.api_key)
     prompt = """
     Ты — генератор русских предложений для изучения немецкого языка.
     Сгенерируй 7 осмысленных, грамматически правильных предложений **на русском языке** для перевода на **немецкий**.
@@ -432,45 +1885,178 @@ async def generate_sentences():
     
     """
 
-    for attempt in range(5):  # Пробуем до 5 раз при ошибке
-        try:
-            response = await client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            sentences = response.choices[0].message.content.split("\n")
-            filtered_sentences = [s.strip() for s in sentences if s.strip()]  # ✅ Фильтруем пустые строки
-            if filtered_sentences:
-                return filtered_sentences
-        except openai.RateLimitError:
-            wait_time = (attempt + 1) * 2  # Задержка: 2, 4, 6 сек...
-            print(f"⚠️ OpenAI API Rate Limit. Ждем {wait_time} сек...")
-            await asyncio.sleep(wait_time)
+    try:
+        response = await openai_chat(
+            "generate_sentences",
+            model="gpt-4-turbo",
+            messages=[{"role": "user", "content": prompt}],
+        )
+        sentences = response.choices[0].message.content.split("\n")
+        # ✅ Фильтруем пустые строки и убираем нумерацию вида "1." / "2)", если модель её добавила
+        filtered_sentences = [re.sub(r"^\d+[.)]\s*", "", s.strip()) for s in sentences if s.strip()]
+        if filtered_sentences:
+            return filtered_sentences
+    except openai.OpenAIError as e:
+        logging.error(f"❌ Ошибка генерации предложений: {e!r}")
 
-    print("❌ Ошибка: не удалось получить ответ от OpenAI. Используем запасные предложения.")
-    return ["Запасное предложение 1", "Запасное предложение 2"]
+    # Пустой список: пул пополнится при следующем запуске фоновой задачи
+    print("❌ Ошибка: не удалось получить ответ от OpenAI.")
+    return []
 
 
 
 
-async def get_original_sentences():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT sentence FROM sentences ORDER BY RANDOM() LIMIT 5;")
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
+# === Пул заранее сгенерированных предложений ===
+# Используется, когда администратор не загрузил свои предложения в `sentences`.
+# Фоновая задача держит в пуле SENTENCE_POOL_TARGET предложений, чтобы /letsgo и /getmore не ждали GPT.
+SENTENCE_POOL_TARGET = int(os.getenv("SENTENCE_POOL_TARGET", "100"))
+SENTENCE_POOL_LOW_WATER = int(os.getenv("SENTENCE_POOL_LOW_WATER", "30"))
+SENTENCE_POOL_REFILL_MINUTES = int(os.getenv("SENTENCE_POOL_REFILL_MINUTES", "10"))
 
-    if rows:
-        return [row[0] for row in rows]
-    else:
-        print("⚠️ В базе данных нет предложений, генерируем новые через GPT-4...")
-        return await generate_sentences()
+sentence_pool_lock = None  # Не даёт двум пополнениям идти одновременно
+background_tasks = set()  # Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+@instrumented
+async def refill_sentence_pool(context: CallbackContext = None):
+    """Пополняет пул до SENTENCE_POOL_TARGET, если в нём меньше SENTENCE_POOL_LOW_WATER предложений."""
+    global sentence_pool_lock
+    if sentence_pool_lock is None:
+        sentence_pool_lock = asyncio.Lock()
+    if sentence_pool_lock.locked():
+        return  # Пополнение уже идёт
+
+    async with sentence_pool_lock:
+        async with get_db_connection() as conn:
+            cursor = await conn.execute("SELECT COUNT(*) FROM sentence_pool;")
+            pool_size = (await cursor.fetchone())[0]
+
+        if pool_size >= SENTENCE_POOL_LOW_WATER:
+            return
+
+        print(f"🔄 В пуле {pool_size} предложений, пополняем до {SENTENCE_POOL_TARGET}...")
+        max_rounds = 2 * (SENTENCE_POOL_TARGET - pool_size) // 7 + 2  # Генерация даёт ~7 предложений за запрос
+
+        for _ in range(max_rounds):
+            if pool_size >= SENTENCE_POOL_TARGET:
+                break
+            generated = await generate_sentences()
+            if not generated:
+                break
+
+            # Без дублей: ни внутри пула, ни с предложениями администратора
+            async with get_db_connection() as conn:
+                cursor = await conn.execute("""
+                    INSERT INTO sentence_pool (sentence)
+                    SELECT DISTINCT g.sentence FROM unnest(%s::text[]) AS g(sentence)
+                    WHERE NOT EXISTS (SELECT 1 FROM sentences s WHERE s.sentence = g.sentence)
+                    ON CONFLICT (sentence) DO NOTHING;
+                """, (generated,))
+                pool_size += cursor.rowcount
+
+        print(f"✅ Пул предложений пополнен: {pool_size}.")
+
+
+async def take_from_sentence_pool(count):
+    """Забирает из пула `count` предложений (FIFO); при нехватке запускает пополнение в фоне."""
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("""
+            WITH taken AS (
+                DELETE FROM sentence_pool
+                WHERE id IN (SELECT id FROM sentence_pool ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+                RETURNING sentence
+            )
+            SELECT sentence, (SELECT COUNT(*) FROM sentence_pool) FROM taken;
+        """, (count,))
+        rows = await cursor.fetchall()
+
+    remaining = rows[0][1] - len(rows) if rows else 0
+    if remaining < SENTENCE_POOL_LOW_WATER:
+        start_background_task(refill_sentence_pool())
+
+    return [row[0] for row in rows]
+
+
+async def get_original_sentences(user_id, count=5):
+    """Выбирает `count` случайных предложений, которые пользователю ещё не выдавались.
+
+    Вместо ORDER BY RANDOM() (сортировка всей таблицы) берём строки по индексу
+    `random_key`, начиная со случайной точки, и при нехватке продолжаем с начала
+    диапазона. Выданным строкам ключ перемешивается, чтобы соседние по ключу
+    предложения не выпадали всегда вместе. Стоимость — O(count), а не O(размер таблицы).
+    """
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("""
+            WITH picked AS (
+                SELECT id, sentence FROM (
+                    (SELECT s.id, s.sentence FROM sentences s
+                     WHERE s.random_key >= %(start)s
+                       AND NOT EXISTS (SELECT 1 FROM daily_sentences ds
+                                       WHERE ds.user_id = %(user_id)s AND md5(ds.sentence) = md5(s.sentence))
+                     ORDER BY s.random_key
+                     LIMIT %(count)s)
+                    UNION ALL
+                    (SELECT s.id, s.sentence FROM sentences s
+                     WHERE s.random_key < %(start)s
+                       AND NOT EXISTS (SELECT 1 FROM daily_sentences ds
+                                       WHERE ds.user_id = %(user_id)s AND md5(ds.sentence) = md5(s.sentence))
+                     ORDER BY s.random_key
+                     LIMIT %(count)s)
+                ) candidates
+                LIMIT %(count)s
+            ),
+            reshuffled AS (
+                UPDATE sentences s SET random_key = random() FROM picked WHERE s.id = picked.id
+            )
+            SELECT sentence FROM picked;
+        """, {"start": random.random(), "user_id": user_id, "count": count})
+        rows = await cursor.fetchall()
+
+    sentences = [row[0] for row in rows]
+    if len(sentences) < count:
+        # Невыданных предложений в базе не хватило — добираем недостающие из пула,
+        # а если пуст и он, генерируем прямо сейчас (как до появления пула)
+        print(f"⚠️ Новых предложений для пользователя в базе {len(sentences)} из {count}, добираем из пула...")
+        sentences += await take_from_sentence_pool(count - len(sentences))
+    if len(sentences) < count:
+        sentences += (await generate_sentences())[:count - len(sentences)]
+    return sentences
+
+
+async def assign_sentences(cursor, chat_id, user_id, sentences):
+    """Записывает задания пользователю одним запросом и возвращает строки «номер. предложение».
+
+    Номера берутся из daily_sentence_counters: строка счётчика блокируется до конца
+    транзакции, так что два одновременных /letsgo или /getmore получат подряд идущие
+    номера без повторов (уникальность дополнительно гарантирует constraint в daily_sentences).
+    """
+    await cursor.execute("""
+        WITH counter AS (
+            INSERT INTO daily_sentence_counters (chat_id, user_id, date, last_unique_id)
+            VALUES (%(chat_id)s, %(user_id)s, CURRENT_DATE, %(count)s)
+            ON CONFLICT (chat_id, user_id, date) DO UPDATE
+            SET last_unique_id = daily_sentence_counters.last_unique_id + EXCLUDED.last_unique_id
+            RETURNING last_unique_id - %(count)s AS last_before
+        )
+        INSERT INTO daily_sentences (chat_id, date, sentence, unique_id, user_id)
+        SELECT %(chat_id)s, CURRENT_DATE, s.sentence, counter.last_before + s.n, %(user_id)s
+        FROM counter, unnest(%(sentences)s::TEXT[]) WITH ORDINALITY AS s (sentence, n)
+        RETURNING unique_id, sentence;
+    """, {"chat_id": chat_id, "user_id": user_id, "count": len(sentences), "sentences": sentences})
+    return [f"{unique_id}. {sentence}" for unique_id, sentence in sorted(await cursor.fetchall())]
 
 
 
 
 # Бот принимает предложения только в личке От админа группы
+@instrumented
 async def set_new_tasks(update: Update, context: CallbackContext):
     user = update.message.from_user
     chat_id = update.message.chat.id
@@ -487,14 +2073,10 @@ async def set_new_tasks(update: Update, context: CallbackContext):
         return
 
     # ✅ Сохраняем новые предложения в БД
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM sentences;")
-    for task in new_tasks:
-        cursor.execute("INSERT INTO sentences (sentence) VALUES (%s);", (task,))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("DELETE FROM sentences;")
+            await cursor.executemany("INSERT INTO sentences (sentence) VALUES (%s);", [(task,) for task in new_tasks])
     
     await update.message.reply_text("✅ Новые задания сохранены! Они появятся в группе завтра утром.")
 
@@ -506,55 +2088,44 @@ application = None  # Глобальная переменная для хран
 
 
 
+@instrumented
 async def send_more_tasks(update: Update, context: CallbackContext):
     user = update.message.from_user
     user_id = user.id
     username = user.username or user.first_name
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Проверяем, начинал ли пользователь перевод
-    cursor.execute("SELECT start_time FROM user_progress WHERE user_id = %s;", (user_id,))
-    row = cursor.fetchone()
+    chat_id = await resolve_chat_id(update)
+
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 Проверяем, начинал ли пользователь перевод
+            await cursor.execute("SELECT start_time FROM user_progress WHERE chat_id = %s AND user_id = %s;", (chat_id, user_id))
+            row = await cursor.fetchone()
+
+            if row:
+                # 🔹 Фиксируем **новое время старта** (но НЕ сбрасываем старое!)
+                await cursor.execute(
+                    """
+                    INSERT INTO user_progress (chat_id, user_id, username, start_time, completed)
+                    VALUES (%s, %s, %s, NOW(), FALSE)
+                    ON CONFLICT (chat_id, user_id, start_time) DO UPDATE 
+                    SET start_time = NOW(), completed = FALSE;
+                    """,
+                    (chat_id, user_id, username)
+                )
 
     if not row:
         await update.message.reply_text("❌ Вы ещё не начинали перевод! Используйте /letsgo.")
-        cursor.close()
-        conn.close()
         return
 
-    # 🔹 Фиксируем **новое время старта** (но НЕ сбрасываем старое!)
-    cursor.execute(
-        """
-        INSERT INTO user_progress (user_id, username, start_time, completed)
-        VALUES (%s, %s, NOW(), FALSE)
-        ON CONFLICT (user_id, start_time) DO UPDATE 
-        SET start_time = NOW(), completed = FALSE;
-        """,
-        (user_id, username)
-    )
-
-    # 🔹 **Определяем стартовый индекс**
-    cursor.execute("SELECT COUNT(*) FROM daily_sentences WHERE date = CURRENT_DATE AND user_id = %s;", (user_id,))
-    last_index = cursor.fetchone()[0]  # Количество уже выданных предложений пользователю
+    # 🔹 Генерируем новые предложения (✅ пустые строки пропускаем)
+    sentences = [s for s in await get_original_sentences(user_id) if s.strip()]
 
-    # 🔹 Генерируем новые предложения
-    sentences = await get_original_sentences()
-    tasks = []
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 Номера продолжают уже выданные сегодня — одним запросом, без гонок при двойном нажатии
+            tasks = await assign_sentences(cursor, chat_id, user_id, sentences)
 
-    for i, sentence in enumerate(sentences, start=last_index + 1):  # **Исправлено!**
-        if not sentence.strip(): # ✅ Пропускаем пустые строки
-            continue
-        cursor.execute(
-            "INSERT INTO daily_sentences (date, sentence, unique_id, user_id) VALUES (CURRENT_DATE, %s, %s, %s);",
-            (sentence, i, user_id)
-        )
-        tasks.append(f"{i}. {sentence}")  # **Теперь нумерация корректная!**
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+            await add_assigned_stats(cursor, chat_id, user_id, username, len(tasks))
 
     # 🔹 Отправляем пользователю новые предложения
     message = (
@@ -571,12 +2142,34 @@ async def send_more_tasks(update: Update, context: CallbackContext):
 
 
 # === GPT-4 Функция для оценки перевода ===
+GRADING_MODEL = "gpt-4-turbo"
+GRADING_PROMPT_VERSION = "v2"  # Увеличить при изменении промпта проверки: старые оценки в кэше перестанут совпадать
+MAX_FEEDBACK_LENGTH = 1000  # Ограничим длину каждого текстового поля оценки в ответе пользователю
 
 import asyncio
 
+
+class GradingResult(BaseModel):
+    """Оценка одного перевода: проверенный ответ GPT, он же строка translations (score, errors, correct_translation, synonym)."""
+    score: int = Field(ge=0, le=100)
+    errors: str = ""
+    correct_translation: str = Field(min_length=1)
+    synonym: str = ""
+
+    @field_validator("errors", "correct_translation", "synonym", mode="before")
+    @classmethod
+    def strip_text(cls, value):
+        return "" if value is None else str(value).strip()
+
+
+GRADING_JSON_FORMAT = (
+    '{"score": <0-100>, "errors": "<объяснение, только если оценка ниже 75, иначе пустая строка>", '
+    '"correct_translation": "...", "synonym": "..."}'
+)
+
+
 async def check_translation(original_text, user_translation):
-    client = openai.AsyncOpenAI(api_key=openai.api_key)  # Новый API-клиент
-    
+    """Проверяет перевод через GPT. Возвращает GradingResult или None, если оценку получить не удалось."""
     prompt = f"""
     Ты профессиональный лингвист и преподаватель немецкого языка.
     Твоя задача — проверить перевод с **русского** на **немецкий**.
@@ -588,33 +2181,466 @@ async def check_translation(original_text, user_translation):
     1. **Выставь оценку от 0 до 100** в соответствии оригинальному содержанию, правильному набору лексики, корректности грамматической конструкции(при выставлении оценки это наиболее весомый критерий) и стиля. При полном несоответствии содержанию оценка ноль).
     2. **Если оценка ниже 75 - обязательно объясни как должна правильно строится основная грамматическая конструкция данного предложения**.
     3. **Обязательно укажи правильный вариант перевода (это должен быть наиболее часто встречаемый максимально аутентичный перевод)**.
-    4. Для смыслового глагола укажи один наиболее часто встречаемый синоним в формате: Синоним:....
+    4. Для смыслового глагола укажи один наиболее часто встречаемый синоним в формате например erhalten/bekommen.
+
+    **Формат ответа — только JSON-объект без лишнего текста**:
+    {GRADING_JSON_FORMAT}
+    """
+
+    try:
+        response = await openai_chat(
+            "check_translation",
+            model=GRADING_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"},
+        )
+        return GradingResult.model_validate_json(response.choices[0].message.content)
+    except openai.OpenAIError as e:
+        logging.error(f"❌ Ошибка проверки перевода: {e!r}")
+    except ValidationError as e:
+        logging.error(f"❌ GPT вернул оценку не по формату: {e.error_count()} ошибок, {e.errors()[0]['msg']}")
+
+    return None
+
+
+
+# === Ограничение одновременных запросов к GPT при проверке переводов ===
+GRADING_MAX_CONCURRENCY = int(os.getenv("GRADING_MAX_CONCURRENCY", "20"))  # Всего запросов одновременно
+GRADING_MAX_PER_USER = int(os.getenv("GRADING_MAX_PER_USER", "10"))  # Запросов одного пользователя одновременно
+
+grading_semaphore = None  # Создаётся при первом использовании внутри цикла событий бота
+user_grading_semaphores = weakref.WeakValueDictionary()  # user_id -> Semaphore, пока кто-то его держит
+
+
+@contextlib.asynccontextmanager
+async def grading_slot(user_id):
+    """Занимает слот для запроса к GPT, соблюдая общий лимит и лимит на пользователя.
+
+    Сначала занимаем слот пользователя, потом общий: длинная пачка одного
+    пользователя не занимает все общие слоты, и очереди разных пользователей чередуются.
+    """
+    global grading_semaphore
+    if grading_semaphore is None:
+        grading_semaphore = asyncio.Semaphore(GRADING_MAX_CONCURRENCY)
+
+    user_semaphore = user_grading_semaphores.get(user_id)
+    if user_semaphore is None:
+        user_semaphore = asyncio.Semaphore(GRADING_MAX_PER_USER)
+        user_grading_semaphores[user_id] = user_semaphore
+
+    async with user_semaphore:
+        async with grading_semaphore:
+            yield
+
 
-    **Формат ответа (без лишних символов, только текст!)**:
-    Оценка: X/100
-    Ошибки: ** объяснение необходимо только если оценка ниже 75, Если оценка выше либо равна 75 ошибки не разбираем.** 
-    Верный перевод: ...
-    Синоним: ... Основного смыслового глагола формате например erhalten/bekommen
+async def check_translation_limited(user_id, original_text, user_translation):
+    """Проверяет один перевод через GPT внутри слота `grading_slot`."""
+    async with grading_slot(user_id):
+        return await check_translation(original_text, user_translation)
+
+
+
+# === Пакетная проверка: все предложения пользователя одним запросом ===
+# "concurrent" — по запросу на предложение (параллельно), "batch" — один запрос на всю пачку
+GRADING_MODE = os.getenv("GRADING_MODE", "concurrent").strip().lower()
+
+
+def truncate_field(text):
+    return text if len(text) <= MAX_FEEDBACK_LENGTH else text[:MAX_FEEDBACK_LENGTH] + "… (сокращено)"
+
+
+def format_grading_feedback(result):
+    """Текст оценки для пользователя; длинные поля обрезаются по отдельности."""
+    return (
+        f"Оценка: {result.score}/100\n"
+        f"Ошибки: {truncate_field(result.errors) or '—'}\n"
+        f"Верный перевод: {truncate_field(result.correct_translation)}\n"
+        f"Синоним: {truncate_field(result.synonym) or '—'}"
+    )
+
+
+def parse_batch_grading(content, count):
+    """Разбирает JSON-ответ пакетной проверки.
+
+    Возвращает {номер предложения (с 1): GradingResult} только для корректных записей;
+    всё, чего нет в словаре, нужно перепроверить по одному.
     """
+    try:
+        records = json.loads(content).get("results")
+    except (ValueError, AttributeError):
+        return {}
 
-    for attempt in range(3):  # До 3-х попыток при ошибках API
+    if not isinstance(records, list):
+        return {}
+
+    parsed = {}
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        index = record.get("index")
+        if not isinstance(index, int) or not 1 <= index <= count or index in parsed:
+            continue
         try:
-            response = await client.chat.completions.create( 
-                model="gpt-4-turbo",
-                messages=[{"role": "user", "content": prompt}]
+            parsed[index] = GradingResult.model_validate(record)
+        except ValidationError:
+            continue
+    return parsed
+
+
+async def check_translations_batch(user_id, items):
+    """Проверяет все переводы пользователя одним запросом со структурированным (JSON) ответом.
+
+    items — список пар (оригинал, перевод). Возвращает список GradingResult в том же порядке.
+    Если ответ модели битый целиком или частично, недостающие предложения
+    перепроверяются по одному через check_translation_limited (в списке может оказаться None или исключение).
+    """
+    sentences_block = "\n".join(
+        f'{i}. Оригинал (на русском): "{original_text}"\n   Перевод пользователя (на немецком): "{user_translation}"'
+        for i, (original_text, user_translation) in enumerate(items, start=1)
+    )
+    prompt = f"""
+    Ты профессиональный лингвист и преподаватель немецкого языка.
+    Твоя задача — проверить несколько переводов с **русского** на **немецкий**. Каждое предложение оценивай независимо.
+
+    {sentences_block}
+
+    **Требования к проверке каждого предложения**:
+    1. **Выставь оценку от 0 до 100** в соответствии оригинальному содержанию, правильному набору лексики, корректности грамматической конструкции(при выставлении оценки это наиболее весомый критерий) и стиля. При полном несоответствии содержанию оценка ноль).
+    2. **Если оценка ниже 75 - обязательно объясни как должна правильно строится основная грамматическая конструкция данного предложения**.
+    3. **Обязательно укажи правильный вариант перевода (это должен быть наиболее часто встречаемый максимально аутентичный перевод)**.
+    4. Для смыслового глагола укажи один наиболее часто встречаемый синоним в формате например erhalten/bekommen.
+
+    **Формат ответа — только JSON-объект без лишнего текста**:
+    {{"results": [{{"index": <номер предложения>, "score": <0-100>, "errors": "<объяснение, только если оценка ниже 75, иначе пустая строка>", "correct_translation": "...", "synonym": "..."}}]}}
+    В "results" должна быть ровно одна запись на каждое предложение ({len(items)} шт.).
+    """
+
+    parsed = {}
+    try:
+        async with grading_slot(user_id):
+            response = await openai_chat(
+                "check_translations_batch",
+                model=GRADING_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
+                timeout=OPENAI_TIMEOUT * 2,  # Ответ на всю пачку длиннее одиночного
             )
-            return response.choices[0].message.content.strip()  # Убираем лишние пробелы
-        except openai.RateLimitError:
-            wait_time = (attempt + 1) * 5  # 5, 10, 15 секунд
-            print(f"⚠️ OpenAI API перегружен. Ждём {wait_time} сек...")
-            await asyncio.sleep(wait_time)
+        parsed = parse_batch_grading(response.choices[0].message.content, len(items))
+    except openai.OpenAIError as e:
+        logging.error(f"❌ Ошибка пакетной проверки: {e!r}")
+
+    missing = [i for i in range(1, len(items) + 1) if i not in parsed]
+    if missing:
+        logging.warning(f"⚠️ Пакетная проверка вернула некорректный ответ для {len(missing)} из {len(items)} предложений, проверяем их по одному.")
+        fallback = await asyncio.gather(
+            *(check_translation_limited(user_id, *items[i - 1]) for i in missing),
+            return_exceptions=True,
+        )
+        parsed.update(zip(missing, fallback))
 
-    return "❌ Ошибка: Не удалось получить оценку. Попробуйте позже."
+    return [parsed[i] for i in range(1, len(items) + 1)]
 
 
 
-import re
+# === Кэш оценок: LRU в памяти процесса + таблица grading_cache в PostgreSQL ===
+GRADING_CACHE_MEMORY_SIZE = int(os.getenv("GRADING_CACHE_MEMORY_SIZE", "5000"))  # Записей в памяти
+GRADING_CACHE_DB_MAX_ROWS = int(os.getenv("GRADING_CACHE_DB_MAX_ROWS", "200000"))  # Записей в таблице
+GRADING_CACHE_TTL_DAYS = int(os.getenv("GRADING_CACHE_TTL_DAYS", "90"))
+
+grading_cache_memory = OrderedDict()  # cache_key -> (время истечения, GradingResult)
+grading_cache_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0}
+
+
+def normalize_for_cache(text):
+    """Нормализует текст для ключа кэша: Unicode NFC и схлопнутые пробелы (регистр сохраняем — он важен в немецком)."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def grading_cache_key(original_text, user_translation):
+    raw = "\x1f".join((
+        GRADING_MODEL,
+        GRADING_PROMPT_VERSION,
+        normalize_for_cache(original_text),
+        normalize_for_cache(user_translation),
+    ))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def remember_grading(cache_key, result):
+    """Кладёт оценку в LRU в памяти, вытесняя самые давно использованные записи."""
+    grading_cache_memory[cache_key] = (time.monotonic() + GRADING_CACHE_TTL_DAYS * 86400, result)
+    grading_cache_memory.move_to_end(cache_key)
+    while len(grading_cache_memory) > GRADING_CACHE_MEMORY_SIZE:
+        grading_cache_memory.popitem(last=False)
+
+
+async def get_cached_gradings(cache_keys):
+    """Ищет оценки сначала в памяти, затем одним запросом в PostgreSQL.
+
+    Возвращает {cache_key: GradingResult} для найденных ключей.
+    """
+    found = {}
+    now = time.monotonic()
+    db_keys = []
+
+    for cache_key in cache_keys:
+        entry = grading_cache_memory.get(cache_key)
+        if entry and entry[0] > now:
+            grading_cache_memory.move_to_end(cache_key)
+            found[cache_key] = entry[1]
+            grading_cache_stats["memory_hits"] += 1
+        else:
+            grading_cache_memory.pop(cache_key, None)
+            db_keys.append(cache_key)
+
+    if db_keys:
+        async with get_db_connection() as conn:
+            # Один запрос и читает запись, и отмечает обращение к ней (для вытеснения по размеру)
+            cursor = await conn.execute("""
+                UPDATE grading_cache SET last_hit_at = NOW()
+                WHERE cache_key = ANY(%s) AND created_at > NOW() - make_interval(days => %s)
+                RETURNING cache_key, result;
+            """, (db_keys, GRADING_CACHE_TTL_DAYS))
+            rows = await cursor.fetchall()
+
+        for cache_key, result in rows:
+            result = GradingResult.model_validate(result)
+            remember_grading(cache_key, result)
+            found[cache_key] = result
+        grading_cache_stats["db_hits"] += len(rows)
+        grading_cache_stats["misses"] += len(db_keys) - len(rows)
+
+    return found
+
+
+async def store_gradings(cursor, entries):
+    """Сохраняет новые оценки [(cache_key, GradingResult), ...] в память и в таблицу (в транзакции вызывающего)."""
+    if not entries:
+        return
+    for cache_key, result in entries:
+        remember_grading(cache_key, result)
+    await cursor.executemany("""
+        INSERT INTO grading_cache (cache_key, result)
+        VALUES (%s, %s::jsonb)
+        ON CONFLICT (cache_key) DO UPDATE
+        SET result = EXCLUDED.result, created_at = NOW(), last_hit_at = NULL;
+    """, [(cache_key, result.model_dump_json()) for cache_key, result in entries])
+    grading_cache_stats["stores"] += len(entries)
+
+
+def grading_cache_hit_rate():
+    hits = grading_cache_stats["memory_hits"] + grading_cache_stats["db_hits"]
+    total = hits + grading_cache_stats["misses"]
+    return hits / total if total else 0.0
+
+
+@instrumented
+async def purge_grading_cache(context: CallbackContext = None):
+    """Удаляет из таблицы просроченные записи и самые старые сверх GRADING_CACHE_DB_MAX_ROWS."""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "DELETE FROM grading_cache WHERE created_at <= NOW() - make_interval(days => %s);",
+                (GRADING_CACHE_TTL_DAYS,)
+            )
+            expired = cursor.rowcount
+            await cursor.execute("""
+                DELETE FROM grading_cache
+                WHERE cache_key IN (
+                    SELECT cache_key FROM grading_cache
+                    ORDER BY COALESCE(last_hit_at, created_at) DESC
+                    OFFSET %s
+                );
+            """, (GRADING_CACHE_DB_MAX_ROWS,))
+            evicted = cursor.rowcount
+
+    logging.info(
+        f"🧹 Кэш оценок: удалено просроченных {expired}, вытеснено {evicted}. "
+        f"Попадания: {grading_cache_hit_rate():.1%} {grading_cache_stats}"
+    )
+
+
+
+# === Локальная предпроверка переводов ===
+# Очевидные случаи решаются без запроса к GPT:
+#   - пустой перевод или перевод без букв;
+#   - перевод написан по-русски (кириллицы больше половины букв);
+#   - перевод несоразмерно короче оригинала;
+#   - перевод в точности совпадает с эталонным (с учётом регистра и умлаутов).
+# Всё остальное, в том числе почти совпадающие переводы, уходит в GPT как обычно: в немецком
+# «mit den Kollegen» вместо «mit dem Kollegen» отличается одной буквой, и это именно та ошибка,
+# которую бот должен поймать.
+# Эталоны — только верные переводы из ответов GPT: перевод пользователя с высокой оценкой
+# всё равно может содержать мелкую ошибку, и на него стали бы ровняться следующие ответы.
+PREGRADER_ENABLED = os.getenv("PREGRADER_ENABLED", "1") == "1"
+PREGRADER_MIN_LENGTH_RATIO = float(os.getenv("PREGRADER_MIN_LENGTH_RATIO", "0.3"))  # Длина перевода к длине оригинала
+PREGRADER_MAX_REFERENCES = 50  # Сколько последних эталонов предложения сравнивать
+
+PREGRADER_DECISIONS = Counter("bot_pregrader_decisions", "Решения локальной предпроверки", ["outcome"])
+pregrader_stats = {"empty": 0, "wrong_language": 0, "too_short": 0, "reference_match": 0, "escalated": 0}
+
+
+def sentence_hash(original_text):
+    return hashlib.sha256(normalize_for_cache(original_text).encode("utf-8")).hexdigest()
+
+
+def normalize_for_match(text):
+    """Нормализует перевод для сравнения с эталоном: Unicode NFC, схлопнутые пробелы, без кавычек и точки в конце.
+
+    Регистр, умлауты и окончания не трогаем — они и есть предмет проверки.
+    """
+    text = " ".join(unicodedata.normalize("NFC", text).split())
+    return text.strip("\"'«»„“”").rstrip(".!…").rstrip()
+
+
+def pregrade(original_text, user_translation, references):
+    """Возвращает (исход, GradingResult) для очевидного случая или None, если нужна проверка GPT."""
+    letters = [char for char in user_translation if char.isalpha()]
+    best_reference = references[0] if references else "—"
+
+    if not letters:
+        return "empty", GradingResult(
+            score=0, errors="Перевод пустой.", correct_translation=best_reference)
+
+    cyrillic = sum(1 for char in letters if "\u0400" <= char <= "\u04ff")
+    if cyrillic / len(letters) > 0.5:
+        return "wrong_language", GradingResult(
+            score=0, errors="Перевод написан по-русски — нужен перевод на немецкий.", correct_translation=best_reference)
+
+    original_letters = sum(1 for char in original_text if char.isalpha())
+    if original_letters and len(letters) / original_letters < PREGRADER_MIN_LENGTH_RATIO:
+        return "too_short", GradingResult(
+            score=0, errors="Перевод слишком короткий: переведено не всё предложение.", correct_translation=best_reference)
+
+    normalized = normalize_for_match(user_translation)
+    for reference in references:
+        if normalize_for_match(reference) == normalized:
+            return "reference_match", GradingResult(score=100, correct_translation=reference)
+
+    return None
+
+
+async def pregrade_translations(items):
+    """Предпроверяет items [(позиция, номер, id предложения, оригинал, перевод), ...] одним запросом к базе.
+
+    Возвращает {позиция: GradingResult} для решённых локально.
+    """
+    if not PREGRADER_ENABLED or not items:
+        return {}
+
+    hashes = {item[0]: sentence_hash(item[3]) for item in items}
+    references = {}
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("""
+            SELECT sentence_hash, translation FROM reference_translations
+            WHERE sentence_hash = ANY(%s)
+            ORDER BY id DESC;
+        """, (list(set(hashes.values())),))
+        for hash_value, translation in await cursor.fetchall():
+            references.setdefault(hash_value, [])
+            if len(references[hash_value]) < PREGRADER_MAX_REFERENCES:
+                references[hash_value].append(translation)
+
+    decided = {}
+    for index, _, _, original_text, user_translation in items:
+        verdict = pregrade(original_text, user_translation, references.get(hashes[index], []))
+        outcome, result = verdict or ("escalated", None)
+        PREGRADER_DECISIONS.labels(outcome).inc()
+        pregrader_stats[outcome] += 1
+        if result is not None:
+            decided[index] = result
+    return decided
+
+
+async def store_reference_translations(cursor, entries):
+    """Сохраняет эталоны [(оригинал, перевод, источник), ...] (в транзакции вызывающего)."""
+    if not entries:
+        return
+    await cursor.executemany("""
+        INSERT INTO reference_translations (sentence_hash, translation, source)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (sentence_hash, translation) DO NOTHING;
+    """, [(sentence_hash(original_text), translation, source) for original_text, translation, source in entries])
+
+
+
+# === Потоковая выдача результатов проверки ===
+# FEEDBACK_STREAMING=sentence|completion: сразу после /translate бот отправляет сообщение-заготовку
+# и правит его по мере готовности оценок — в порядке предложений (ещё не проверенные помечены ⏳)
+# или в порядке готовности. off — один ответ после проверки всех предложений, как раньше.
+# Правки идут через очередь отправки и в группе делят с остальными сообщениями лимит Telegram
+# (~20 в минуту), поэтому правим не чаще FEEDBACK_EDIT_INTERVAL секунд.
+FEEDBACK_STREAMING = os.getenv("FEEDBACK_STREAMING", "off").strip().lower()
+FEEDBACK_EDIT_INTERVAL = float(os.getenv("FEEDBACK_EDIT_INTERVAL", "1.5"))
+
+
+class FeedbackStream:
+    """Ответ с результатами, который обновляется по мере проверки.
+
+    Текст длиннее TELEGRAM_MAX_MESSAGE_LENGTH разбивается на части так же, как в очереди отправки:
+    на каждую часть — своё сообщение, которое затем только редактируется.
+    show() ничего не ждёт: части ставятся в очередь отправки, а правка части уходит, как только
+    её сообщение доставлено, — проверка не стоит в очереди Telegram вместе с ответом.
+    """
+
+    def __init__(self, update: Update):
+        self.update = update
+        self.bot = update.message.get_bot()
+        self.chat_id = update.message.chat_id
+        self.messages = []  # future отправленного сообщения каждой части текста
+        self.texts = []  # Последний текст каждой части
+        self.sent_texts = []  # Текст, который сейчас показан в сообщении части
+        self.last_update = 0.0
+        self.final_text = None
+        self.broken = False  # Не удалось отправить заготовку — итог уйдёт обычным ответом
+
+    def show(self, text, force=False, final=False):
+        if final:
+            self.final_text = text
+        if self.broken:
+            if final:
+                reply_queued(self.update, text)
+            return
+        if not (force or final) and time.monotonic() - self.last_update < FEEDBACK_EDIT_INTERVAL:
+            return
+        self.last_update = time.monotonic()
+
+        for i, part in enumerate(split_message(text)):
+            if i < len(self.messages):
+                self.texts[i] = part
+                if self.messages[i].done():
+                    self.edit(i)
+                continue
+            future = reply_queued(self.update, part, coalesce=False)
+            self.messages.append(future)
+            self.texts.append(part)
+            self.sent_texts.append(part)
+            future.add_done_callback(functools.partial(self.delivered, i))
+
+    def delivered(self, index, future):
+        if future.cancelled() or future.exception() is not None:
+            error = "отменено" if future.cancelled() else repr(future.exception())
+            logging.error(f"❌ Не удалось отправить результаты проверки: {error}")
+            if index == 0 and not self.broken:
+                self.broken = True
+                if self.final_text is not None:
+                    reply_queued(self.update, self.final_text)
+            return
+        self.edit(index)  # Пока сообщение ждало отправки, текст мог обновиться
+
+    def edit(self, index):
+        future = self.messages[index]
+        if future.cancelled() or future.exception() is not None or self.texts[index] == self.sent_texts[index]:
+            return
+        enqueue_edit(self.bot, self.chat_id, future.result().message_id, self.texts[index])
+        self.sent_texts[index] = self.texts[index]
+
 
+def already_translated_message(sentence_number):
+    return f"⚠️ Вы уже переводили предложение {sentence_number}. Только первый перевод учитывается!"
+
+
+@instrumented
 async def check_user_translation(update: Update, context: CallbackContext):
     if not update.message or not update.message.text:
         return  
@@ -631,7 +2657,7 @@ async def check_user_translation(update: Update, context: CallbackContext):
 
     # Разбираем входной текст на номера предложений и переводы [('1', 'Hallo Welt'), ('2', 'Wie geht es dir?'), ('3', 'Ich liebe Programmierung.')]
     pattern = re.compile(r"(\d+)\.\s*(.+)")
-    translations = pattern.findall(translations_text)
+    translations = sorted(pattern.findall(translations_text), key=lambda item: int(item[0]))  # Результаты выводим по номеру предложения
 
     if not translations:
         await update.message.reply_text("❌ Ошибка: Используйте формат: \n\n/translate\n1. <перевод>\n2. <перевод>")
@@ -639,156 +2665,246 @@ async def check_user_translation(update: Update, context: CallbackContext):
 
     user_id = update.message.from_user.id
     username = update.message.from_user.first_name
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Получаем **ID предложений, которые принадлежат пользователю**
-    cursor.execute(
-        "SELECT unique_id FROM daily_sentences WHERE date = CURRENT_DATE AND user_id = %s;", 
-        (user_id,)
-    )
-    allowed_sentences = {row[0] for row in cursor.fetchall()}  # Собираем в set() для быстрого поиска
+    chat_id = await resolve_chat_id(update)
 
     results = []  # Храним результаты для Telegram
+    pending = []  # Переводы, которые нужно проверить: (позиция в results, номер, id предложения, оригинал, перевод)
+    assigned_dates = {}  # id предложения -> дата выдачи (для user_daily_stats)
+    submitted_ids = set()  # id предложений из этого сообщения (повторный номер в одном сообщении не учитываем)
+
+    async with get_db_connection() as conn:
+        # 🔹 Одним запросом: все предложения пользователя за сегодня и отметка, переведены ли они уже
+        cursor = await conn.execute("""
+            SELECT unique_id, id, sentence, date, translated_at IS NOT NULL
+            FROM daily_sentences
+            WHERE chat_id = %s AND user_id = %s AND date = CURRENT_DATE;
+        """, (chat_id, user_id))
+        assigned = {row[0]: row[1:] for row in await cursor.fetchall()}  # номер -> (id, оригинал, дата выдачи, уже переведено)
 
     for number_str, user_translation in translations:
         sentence_number = int(number_str)
 
         # 🔹 **Проверяем, принадлежит ли это предложение пользователю**
-        if sentence_number not in allowed_sentences:
+        if sentence_number not in assigned:
             results.append(f"❌ Ошибка: Предложение {sentence_number} вам не принадлежит!")
             continue
 
-        # 🔹 **Получаем оригинальный текст предложения**
-        cursor.execute(
-            "SELECT id, sentence FROM daily_sentences WHERE date = CURRENT_DATE AND unique_id = %s AND user_id = %s;",
-            (sentence_number, user_id)
-        )
-        row = cursor.fetchone()
+        sentence_id, original_text, assigned_date, already_translated = assigned[sentence_number]
+        assigned_dates[sentence_id] = assigned_date
 
-        if not row:
-            results.append(f"❌ Ошибка: Предложение {sentence_number} не найдено.")
+        # 🔹 **Проверяем, отправлял ли этот пользователь перевод этого предложения**
+        if already_translated or sentence_id in submitted_ids:
+            results.append(already_translated_message(sentence_number))
             continue
 
-        sentence_id, original_text = row
+        submitted_ids.add(sentence_id)
 
-        # 🔹 **Проверяем, отправлял ли этот пользователь перевод этого предложения**
-        cursor.execute(
-            "SELECT id FROM translations WHERE user_id = %s AND sentence_id = %s AND timestamp::date = CURRENT_DATE;",
-            (user_id, sentence_id)
-        )
-        existing_translation = cursor.fetchone()
+        pending.append((len(results), sentence_number, sentence_id, original_text, user_translation))
+        results.append(None)  # Заполним после проверки GPT
 
-        if existing_translation:
-            results.append(f"⚠️ Вы уже переводили предложение {sentence_number}. Только первый перевод учитывается!")
-            continue
+    # 🔹 **Сначала ищем готовые оценки в кэше** (тот же перевод того же предложения уже проверялся)
+    cache_keys = {item[0]: grading_cache_key(item[3], item[4]) for item in pending}
+    cached = await get_cached_gradings(list(cache_keys.values())) if pending else {}
+    to_grade = [item for item in pending if cache_keys[item[0]] not in cached]
+    sentence_numbers = {item[0]: item[1] for item in pending}  # Позиция в results -> номер предложения
 
-        logging.info(f"📌 Проверяем перевод №{sentence_number}: {user_translation}")
+    graded = []
+    failed = []  # Номера предложений, оценку которых получить не удалось
+    new_cache_entries = []
+    new_references = []  # Эталоны из свежих ответов GPT: (оригинал, перевод, источник)
+    ready_order = [i for i, result in enumerate(results) if result is not None]  # Позиции results в порядке готовности
 
-        # 🔹 **Проверяем перевод через GPT**
-        MAX_FEEDBACK_LENGTH = 1000  # Ограничим длину комментария GPT
-        feedback = await check_translation(original_text, user_translation)
+    def record_result(item, result=None, from_gpt=True):
+        """Запоминает оценку (из кэша или свежую) для сохранения и подставляет текст в results.
 
-        # Получаем оценку из строки "Оценка: 85/100"
-        score_match = re.search(r"Оценка:\s*(\d+)/100", feedback)
-        score = int(score_match.group(1)) if score_match else None
+        Если оценку получить не удалось (None или исключение), перевод не сохраняем:
+        пользователь сможет отправить его ещё раз, а в средних не появится пустая оценка.
+        """
+        index, sentence_number, sentence_id, original_text, user_translation = item
+        cache_key = cache_keys[index]
+        if cache_key in cached:
+            result = cached[cache_key]
+        elif isinstance(result, GradingResult):
+            new_cache_entries.append((cache_key, result))
+            if from_gpt:
+                new_references.append((original_text, result.correct_translation, "gpt"))
+        else:
+            if isinstance(result, Exception):
+                logging.error(f"❌ Ошибка при проверке перевода №{sentence_number}: {result!r}")
+            failed.append(sentence_number)
+            results[index] = (
+                f"📜 **Предложение {sentence_number}**\n"
+                "❌ Ошибка: Не удалось получить оценку. Перевод не засчитан — отправьте его ещё раз позже."
+            )
+            ready_order.append(index)
+            return
 
-        # 🔹 **Сохраняем перевод в базу**
-        cursor.execute("""
-            INSERT INTO translations (user_id, username, sentence_id, user_translation, score, feedback)
-            VALUES (%s, %s, %s, %s, %s, %s);""",
-            (user_id, username, sentence_id, user_translation, score, feedback))
+        graded.append((
+            chat_id, user_id, username, sentence_id, user_translation,
+            result.score, result.errors, result.correct_translation, result.synonym,
+        ))
+        results[index] = f"📜 **Предложение {sentence_number}**\n🎯 Оценка: {format_grading_feedback(result)}"
+        ready_order.append(index)
 
-        conn.commit()
+    def render_results(final=False):
+        if FEEDBACK_STREAMING == "completion":
+            blocks = [results[i] for i in ready_order]
+        else:
+            blocks = [result or f"⏳ **Предложение {sentence_numbers[i]}** — проверяем..." for i, result in enumerate(results)]
+        if not final:
+            blocks.append(f"⏳ Проверено {len(graded) + len(failed)} из {len(pending)}...")
+        return "\n\n".join(blocks)
+
+    for item in pending:
+        if cache_keys[item[0]] in cached:
+            record_result(item)
+
+    # 🔹 **Очевидные случаи (пусто, по-русски, слишком коротко, совпадает с эталоном) решаем без GPT**
+    pregraded = await pregrade_translations(to_grade)
+    for item in to_grade:
+        if item[0] in pregraded:
+            record_result(item, pregraded[item[0]], from_gpt=False)
+    to_grade = [item for item in to_grade if item[0] not in pregraded]
+
+    # 🔹 **Остальные проверяем через GPT** — все предложения параллельно (соединение с базой не держим, пока ждём модель).
+    # Запросы стартуют до заготовки ответа: ожидание в очереди Telegram не задерживает проверку
+    for _, sentence_number, _, _, user_translation in to_grade:
+        logging.info(f"📌 Проверяем перевод №{sentence_number}: {user_translation}")
 
-        # Обрезаем, если слишком длинный
-        if len(feedback) > MAX_FEEDBACK_LENGTH:
-            feedback = feedback[:MAX_FEEDBACK_LENGTH] + "...\n⚠️ Ответ GPT был сокращён."
+    async def grade(item):
+        try:
+            return item, await check_translation_limited(user_id, item[3], item[4])
+        except Exception as e:
+            return item, e
+
+    if GRADING_MODE == "batch" and len(to_grade) > 1:
+        batch = asyncio.create_task(check_translations_batch(
+            user_id, [(original_text, user_translation) for _, _, _, original_text, user_translation in to_grade]
+        ))
+    else:
+        batch = None
+        grading_tasks = [asyncio.create_task(grade(item)) for item in to_grade]
 
-        results.append(f"📜 **Предложение {sentence_number}**\n🎯 Оценка: {feedback}")
+    stream = FeedbackStream(update) if FEEDBACK_STREAMING in ("sentence", "completion") and to_grade else None
+    if stream:
+        stream.show(render_results(), force=True)  # Заготовка встаёт в очередь сразу, без троттлинга
 
-    cursor.close()
-    conn.close()
+    if batch is not None:
+        # Пакет приходит целиком, поэтому при потоковой выдаче заготовка обновится один раз
+        for item, result in zip(to_grade, await batch):
+            record_result(item, result)
+    else:
+        for next_graded in asyncio.as_completed(grading_tasks):
+            record_result(*await next_graded)
+            if stream:
+                stream.show(render_results())
+
+    # 🔹 **Сохраняем все переводы (и новые оценки в кэш) в базу одной транзакцией**
+    if graded:
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                # Переводы вставляются одним запросом и только для предложений, которые удалось отметить
+                # переведёнными: если два /translate пришли одновременно, засчитывается первый
+                await cursor.execute("""
+                    WITH claimed AS (
+                        UPDATE daily_sentences SET translated_at = NOW()
+                        WHERE id = ANY(%s) AND translated_at IS NULL
+                        RETURNING id
+                    )
+                    INSERT INTO translations (chat_id, user_id, username, sentence_id, user_translation, score, errors, correct_translation, synonym)
+                    SELECT graded.*
+                    FROM unnest(%s::BIGINT[], %s::BIGINT[], %s::TEXT[], %s::INT[], %s::TEXT[], %s::INT[], %s::TEXT[], %s::TEXT[], %s::TEXT[])
+                        AS graded (chat_id, user_id, username, sentence_id, user_translation, score, errors, correct_translation, synonym)
+                    JOIN claimed ON claimed.id = graded.sentence_id
+                    RETURNING sentence_id;
+                """, ([row[3] for row in graded], *map(list, zip(*graded))))
+                saved_ids = {row[0] for row in await cursor.fetchall()}
+
+                positions = {item[2]: item[0] for item in pending}  # id предложения -> позиция в results
+                for _, _, _, sentence_id, *_ in graded:
+                    if sentence_id not in saved_ids:
+                        results[positions[sentence_id]] = already_translated_message(sentence_numbers[positions[sentence_id]])
+                graded = [row for row in graded if row[3] in saved_ids]
+
+                await store_gradings(cursor, new_cache_entries)
+                await store_reference_translations(cursor, new_references)
+
+                scores_by_date = {}
+                for _, _, _, sentence_id, _, score, *_ in graded:
+                    scores_by_date.setdefault(assigned_dates[sentence_id], []).append(score)
+                for assigned_date, scores in scores_by_date.items():
+                    await add_translation_stats(cursor, chat_id, user_id, username, assigned_date, scores)
 
     # Отправляем пользователю результаты всех переводов
-    # Разбиваем сообщение, если оно длинное
-    MAX_MESSAGE_LENGTH = 4000  # Чтобы не рисковать, оставляем небольшой запас
-    message_text = "\n\n".join(results)
-
-    if len(message_text) > MAX_MESSAGE_LENGTH:
-        parts = [message_text[i:i+MAX_MESSAGE_LENGTH] for i in range(0, len(message_text), MAX_MESSAGE_LENGTH)]
-        for part in parts:
-            await update.message.reply_text(part)
+    # (очередь отправки сама разбивает длинное сообщение на части и соблюдает лимиты Telegram)
+    message_text = render_results(final=True)
+    logging.info(f"📩 Длина сообщения: {len(message_text)} символов")
+    if stream:
+        stream.show(message_text, final=True)
     else:
-        logging.info(f"📩 Длина сообщения: {len(message_text)} символов")
-        await update.message.reply_text(message_text)
-
-
-
-
-
-async def send_progress_report(context: CallbackContext):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Получаем всех пользователей, которые писали в чат **за месяц**
-    cursor.execute("""
-        SELECT DISTINCT user_id, username 
-        FROM messages 
-        WHERE timestamp >= date_trunc('month', CURRENT_DATE);
-    """)
-    all_users = {row[0]: row[1] for row in cursor.fetchall()}
-
-    # 🔹 Получаем всех, кто перевёл хотя бы одно предложение **за сегодня**
-    cursor.execute("""
-        SELECT DISTINCT user_id FROM translations WHERE timestamp::date = CURRENT_DATE;
-    """)
-    active_users = {row[0] for row in cursor.fetchall()}
-
-    # 🔹 Собираем статистику по пользователям **за сегодня**(checked)
-    cursor.execute("""
-        SELECT 
-        ds.user_id,
-        COUNT(DISTINCT ds.id) AS всего_предложений,
-        COUNT(DISTINCT t.id) AS переведено,
-        (COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) AS пропущено,
-        COALESCE(p.avg_time, 0) AS среднее_время_сессии_в_минутах, -- ✅ Среднее время за день
-        COALESCE(p.total_time, 0) AS общее_время_за_день, -- ✅ Общее время за день
-        COALESCE(AVG(t.score), 0) AS средняя_оценка,
-        COALESCE(AVG(t.score), 0) 
-            - (COALESCE(p.avg_time, 0) * 2) -- ✅ Используем среднее время в расчётах
-            - ((COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) * 20) AS итоговый_балл
-    FROM daily_sentences ds
-    LEFT JOIN translations t ON ds.user_id = t.user_id AND ds.id = t.sentence_id
-    LEFT JOIN (
-        SELECT user_id, 
-            AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time, -- ✅ Среднее время сессии за день
-            SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time -- ✅ Общее время за день
-        FROM user_progress
-        WHERE completed = TRUE 
-            AND start_time::date = CURRENT_DATE -- ✅ Теперь только за день
-        GROUP BY user_id
-    ) p ON ds.user_id = p.user_id
-    WHERE ds.date = CURRENT_DATE
-    GROUP BY ds.user_id, p.avg_time, p.total_time
+        reply_queued(update, message_text)
+
+
+
+
+
+# Все, кто писал в группу в этом месяце, и их последнее имя (для блока про ленивцев)
+MONTH_MEMBERS_SQL = """
+    SELECT m.user_id, a.username
+    FROM chat_member_months m
+    JOIN chat_members_activity a ON a.chat_id = m.chat_id AND a.user_id = m.user_id
+    WHERE m.chat_id = %s AND m.month = date_trunc('month', CURRENT_DATE)::date;
+"""
+
+
+# Статистика всех пользователей группы за сегодня: те же колонки, что раньше считались по сырым таблицам,
+# плюс имя пользователя последней колонкой
+DAILY_STATS_SQL = """
+    SELECT user_id, assigned, translated, missed, avg_minutes, total_minutes, avg_score,
+        avg_score - avg_minutes * 2 - missed * 20 AS итоговый_балл,
+        username
+    FROM (
+        SELECT
+            user_id,
+            username,
+            assigned,
+            translated,
+            assigned - translated AS missed,
+            COALESCE(session_minutes / NULLIF(sessions, 0), 0) AS avg_minutes,
+            session_minutes AS total_minutes,
+            COALESCE(score_sum::float / NULLIF(scored, 0), 0) AS avg_score
+        FROM user_daily_stats
+        WHERE chat_id = %s AND date = CURRENT_DATE AND assigned > 0
+    ) daily
     ORDER BY итоговый_балл DESC;
-    """)
-    rows = cursor.fetchall()
+"""
 
-    cursor.close()
-    conn.close()
+
+@instrumented
+async def send_progress_report(context: CallbackContext, chat_id):
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 Получаем всех пользователей, которые писали в чат **за месяц**
+            await cursor.execute(MONTH_MEMBERS_SQL, (chat_id,))
+            all_users = {row[0]: row[1] for row in await cursor.fetchall()}
+
+            # 🔹 Статистика по пользователям **за сегодня** из агрегатов user_daily_stats
+            await cursor.execute(DAILY_STATS_SQL, (chat_id,))
+            rows = await cursor.fetchall()
+
+    # 🔹 Все, кто перевёл хотя бы одно предложение **за сегодня**
+    active_users = {row[0] for row in rows if row[2] > 0}
 
     # 🔹 Формируем отчёт
     if not rows:
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text="📊 Сегодня никто не перевёл ни одного предложения!")
+        enqueue_message(context.bot, chat_id, "📊 Сегодня никто не перевёл ни одного предложения!")
         return
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     progress_report = f"📊 **Промежуточные итоги перевода:**\n🕒 **Время отчёта: {current_time}**\n\n"
 
-    for user_id, total, translated, missed, avg_minutes, total_minutes, avg_score, final_score in rows:
+    for user_id, total, translated, missed, avg_minutes, total_minutes, avg_score, final_score, username in rows:
         progress_report += (
-            f"👤 **{all_users.get(user_id, 'Неизвестный пользователь')}**\n"
+            f"👤 **{all_users.get(user_id) or username or 'Неизвестный пользователь'}**\n"
             f"📜 Переведено: **{translated}/{total}**\n"
             f"🚨 Не переведено: **{missed}**\n"
             f"⏱ Время среднее: **{avg_minutes:.1f} мин**\n"
@@ -804,75 +2920,37 @@ async def send_progress_report(context: CallbackContext):
         for username in lazy_users.values():
             progress_report += f"👤 {username}: ничего не перевёл!\n"
 
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=progress_report)
+    enqueue_message(context.bot, chat_id, progress_report)
 
 
 
 
 #SQL Запрос проверено
-async def send_daily_summary(context: CallbackContext):
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Собираем активных пользователей (кто перевёл хотя бы одно предложение)
-    cursor.execute("""
-        SELECT DISTINCT user_id, username 
-        FROM translations 
-        WHERE timestamp::date = CURRENT_DATE;
-    """)
-    active_users = {row[0]: row[1] for row in cursor.fetchall()}
-
-    # 🔹 Собираем всех, кто хоть что-то писал в чат
-    cursor.execute("""
-        SELECT DISTINCT user_id, username
-        FROM messages
-        WHERE timestamp >= date_trunc('month', CURRENT_DATE);
-    """)
-    all_users = {row[0]: row[1] for row in cursor.fetchall()}
-
-    # 🔹 Собираем статистику за день
-    cursor.execute("""
-       SELECT 
-            ds.user_id, 
-            COUNT(DISTINCT ds.id) AS total_sentences,
-            COUNT(DISTINCT t.id) AS translated,
-            (COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) AS missed,
-            COALESCE(p.avg_time, 0) AS avg_time_minutes, 
-            COALESCE(p.total_time, 0) AS total_time_minutes, 
-            COALESCE(AVG(t.score), 0) AS avg_score,
-            COALESCE(AVG(t.score), 0) 
-            - (COALESCE(p.avg_time, 0) * 2) 
-            - ((COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) * 20) AS final_score
-        FROM daily_sentences ds
-        LEFT JOIN translations t ON ds.user_id = t.user_id AND ds.id = t.sentence_id
-        LEFT JOIN (
-            SELECT user_id, 
-                AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time, 
-                SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time
-            FROM user_progress
-            WHERE completed = true
-        		AND start_time::date = CURRENT_DATE -- ✅ Теперь только за день
-            GROUP BY user_id
-        ) p ON ds.user_id = p.user_id
-        WHERE ds.date = CURRENT_DATE
-        GROUP BY ds.user_id, p.avg_time, p.total_time
-        ORDER BY final_score DESC;
-    """)
-    rows = cursor.fetchall()
-
-    cursor.close()
-    conn.close()
+@instrumented
+async def send_daily_summary(context: CallbackContext, chat_id):
+
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 Собираем всех, кто хоть что-то писал в чат
+            await cursor.execute(MONTH_MEMBERS_SQL, (chat_id,))
+            all_users = {row[0]: row[1] for row in await cursor.fetchall()}
+
+            # 🔹 Собираем статистику за день из агрегатов user_daily_stats
+            await cursor.execute(DAILY_STATS_SQL, (chat_id,))
+            rows = await cursor.fetchall()
+
+    # 🔹 Активные пользователи (кто перевёл хотя бы одно предложение)
+    active_users = {row[0] for row in rows if row[2] > 0}
 
     # 🔹 Формируем итоговый отчёт
     if not rows:
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text="📊 Сегодня никто не перевёл ни одного предложения!")
+        enqueue_message(context.bot, chat_id, "📊 Сегодня никто не перевёл ни одного предложения!")
         return
 
     summary = "📊 **Итоги дня:**\n\n"
     medals = ["🥇", "🥈", "🥉"]
-    for i, (user_id, total_sentences, translated, missed, avg_minutes, total_time_minutes, avg_score, final_score) in enumerate(rows):
-        username = all_users.get(user_id, 'Неизвестный пользователь')  # ✅ Берём имя пользователя из словаря
+    for i, (user_id, total_sentences, translated, missed, avg_minutes, total_time_minutes, avg_score, final_score, stats_username) in enumerate(rows):
+        username = all_users.get(user_id) or stats_username or 'Неизвестный пользователь'  # ✅ Берём имя пользователя из словаря
         medal = medals[i] if i < len(medals) else "💩"
         summary += (
             f"{medal} **{username}**\n"
@@ -893,60 +2971,40 @@ async def send_daily_summary(context: CallbackContext):
         for username in lazy_users.values():
             summary += f"👤 {username}: ничего не перевёл!\n"
 
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=summary)
+    enqueue_message(context.bot, chat_id, summary)
 
 
 
 
 #SQL Запрос проверено
-async def send_weekly_summary(context: CallbackContext):
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Собираем статистику за неделю
-    cursor.execute("""
-        SELECT 
-        t.username, 
-        COUNT(DISTINCT t.sentence_id) AS всего_переводов,
-        COALESCE(AVG(t.score), 0) AS средняя_оценка,
-        COALESCE(p.avg_time, 0) AS среднее_время_сессии_в_минутах, -- ✅ Среднее время сессии
-        COALESCE(p.total_time, 0) AS общее_время_в_минутах, -- ✅ Теперь есть и общее время
-        (SELECT COUNT(*) 
-        FROM daily_sentences 
-        WHERE date >= CURRENT_DATE - INTERVAL '6 days' 
-        AND user_id = t.user_id) 
-        - COUNT(DISTINCT t.sentence_id) AS пропущено_за_неделю,
-        COALESCE(AVG(t.score), 0) 
-            - (COALESCE(p.avg_time, 0) * 2) -- ✅ Среднее время в штрафе
-            - ((SELECT COUNT(*) 
-                FROM daily_sentences 
-                WHERE date >= CURRENT_DATE - INTERVAL '6 days' 
-                AND user_id = t.user_id) 
-            - COUNT(DISTINCT t.sentence_id)) * 20
-            AS итоговый_балл
-    FROM translations t
-    LEFT JOIN (
-        SELECT user_id, 
-            AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time, -- ✅ Среднее время сессии
-            SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time -- ✅ Общее время
-        FROM user_progress 
-        WHERE completed = TRUE 
-        AND start_time >= CURRENT_DATE - INTERVAL '6 days'
-        GROUP BY user_id
-    ) p ON t.user_id = p.user_id
-    WHERE t.timestamp >= CURRENT_DATE - INTERVAL '6 days'
-    GROUP BY t.username, t.user_id, p.avg_time, p.total_time
-    ORDER BY итоговый_балл DESC;
-
-    """)
-    rows = cursor.fetchall()
-
-    cursor.close()
-    conn.close()
+@instrumented
+async def send_weekly_summary(context: CallbackContext, chat_id):
+
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 🔹 Собираем статистику за неделю из агрегатов user_daily_stats
+            await cursor.execute("""
+                SELECT username, translated, avg_score, avg_minutes, total_minutes, missed,
+                    avg_score - avg_minutes * 2 - missed * 20 AS итоговый_балл
+                FROM (
+                    SELECT
+                        MAX(username) AS username,
+                        SUM(translated) AS translated,
+                        COALESCE(SUM(score_sum)::float / NULLIF(SUM(scored), 0), 0) AS avg_score,
+                        COALESCE(SUM(session_minutes) / NULLIF(SUM(sessions), 0), 0) AS avg_minutes,
+                        SUM(session_minutes) AS total_minutes,
+                        SUM(assigned) - SUM(translated) AS missed
+                    FROM user_daily_stats
+                    WHERE chat_id = %s AND date >= CURRENT_DATE - 6
+                    GROUP BY user_id
+                    HAVING SUM(translated) > 0
+                ) weekly
+                ORDER BY итоговый_балл DESC;
+            """, (chat_id,))
+            rows = await cursor.fetchall()
 
     if not rows:
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text="📊 Неделя прошла, но никто не перевел ни одного предложения!")
+        enqueue_message(context.bot, chat_id, "📊 Неделя прошла, но никто не перевел ни одного предложения!")
         return
 
     summary = "🏆 **Итоги недели:**\n\n"
@@ -964,12 +3022,13 @@ async def send_weekly_summary(context: CallbackContext):
             f"🏆 Итоговый балл: **{final_score:.1f}**\n\n"
         )
 
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=summary)
+    enqueue_message(context.bot, chat_id, summary)
 
 
 
 
-async def send_morning_tasks(context: CallbackContext):
+@instrumented
+async def send_morning_tasks(context: CallbackContext, chat_id):
     message = (
         "🌅 ** Не забудьте начать перевод!**\n\n"
         "Используйте для этого команду `/letsgo`.\n"
@@ -982,13 +3041,14 @@ async def send_morning_tasks(context: CallbackContext):
         "✅ `/stats` - Узнать свою статистику\n"
     )
 
-    await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=message)
+    enqueue_message(context.bot, chat_id, message)
 
 
 
 import asyncio
 
 
+@instrumented
 async def start(update: Update, context: CallbackContext):
     message = (
         "👋 **Привет всем кроме Konchita!**\n"
@@ -1004,83 +3064,51 @@ async def start(update: Update, context: CallbackContext):
 
 
 
+@instrumented
 async def user_stats(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     username = update.message.from_user.first_name
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 📌 Статистика за сегодняшний день (обновлено для среднего времени) Если за семь дней считать то нужно так: WHERE date BETWEEN CURRENT_DATE - INTERVAL '7 days' AND CURRENT_DATE - INTERVAL '1 day'
-    cursor.execute("""
-        SELECT 
-            COUNT(DISTINCT t.sentence_id) AS переведено,  
-            COALESCE(AVG(t.score), 0) AS средняя_оценка,
-            COALESCE((
-                SELECT AVG(EXTRACT(EPOCH FROM (p.end_time - p.start_time)) / 60)  -- ✅ Используем AVG вместо SUM
-                FROM user_progress p
-                WHERE p.user_id = t.user_id 
-                    AND p.start_time::date = CURRENT_DATE
-                    AND p.completed = TRUE
-            ), 0) AS среднее_время_сессии_в_минутах,  -- ✅ Обновили название, чтобы было понятно
-            GREATEST(0, (SELECT COUNT(*) FROM daily_sentences 
-                        WHERE date = CURRENT_DATE AND user_id = t.user_id) - COUNT(DISTINCT t.sentence_id)) AS пропущено,
-            COALESCE(AVG(t.score), 0) 
-                - (COALESCE((
-                    SELECT AVG(EXTRACT(EPOCH FROM (p.end_time - p.start_time)) / 60)  -- ✅ Здесь тоже AVG
-                    FROM user_progress p
-                    WHERE p.user_id = t.user_id 
-                        AND p.start_time::date = CURRENT_DATE
-                        AND p.completed = TRUE
-                ), 0) * 2) 
-                - (GREATEST(0, (SELECT COUNT(*) FROM daily_sentences 
-                                WHERE date = CURRENT_DATE AND user_id = t.user_id) - COUNT(DISTINCT t.sentence_id)) * 20) AS итоговый_балл
-        FROM translations t
-        WHERE t.user_id = %s AND t.timestamp::date = CURRENT_DATE
-        GROUP BY t.user_id;
-    """, (user_id,))
-
-    today_stats = cursor.fetchone()
-
-    # 📌 Недельная статистика (обновлено для среднего времени)
-    cursor.execute("""
-        SELECT 
-            t.user_id,
-            COUNT(DISTINCT t.sentence_id) AS всего_переводов,
-            COALESCE(AVG(t.score), 0) AS средняя_оценка,
-            COALESCE(p.avg_session_time, 0) AS среднее_время_сессии_в_минутах,  
-            COALESCE(p.total_time, 0) AS общее_время_за_неделю,  
-            GREATEST(0, COALESCE(ds.total_sentences, 0) - COUNT(DISTINCT t.sentence_id)) AS пропущено_за_неделю,
-            COALESCE(AVG(t.score), 0) 
-                - (COALESCE(p.avg_session_time, 0) * 2)  
-                - (GREATEST(0, COALESCE(ds.total_sentences, 0) - COUNT(DISTINCT t.sentence_id)) * 20) AS итоговый_балл
-        FROM translations t
-        LEFT JOIN (
-            -- ✅ Отдельный подзапрос для корректного расчёта времени по каждому пользователю
-            SELECT 
-                user_id, 
-                AVG(EXTRACT(EPOCH FROM (end_time - start_time)) / 60) AS avg_session_time, 
-                SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60) AS total_time 
-            FROM user_progress
-            WHERE completed = TRUE 
-                AND start_time >= CURRENT_DATE - INTERVAL '6 days'
-            GROUP BY user_id
-        ) p ON t.user_id = p.user_id
-        LEFT JOIN (
-            SELECT user_id, COUNT(*) AS total_sentences
-            FROM daily_sentences
-            WHERE date >= CURRENT_DATE - INTERVAL '6 days'
-            GROUP BY user_id
-        ) ds ON t.user_id = ds.user_id
-        WHERE t.timestamp >= CURRENT_DATE - INTERVAL '6 days' 
-            AND t.user_id = %s  -- ✅ Фильтр по конкретному пользователю
-        GROUP BY t.user_id, p.avg_session_time, p.total_time, ds.total_sentences;
-    """, (user_id,))
-
-    weekly_stats = cursor.fetchone()
-
-    cursor.close()
-    conn.close()
+    chat_id = await resolve_chat_id(update)
+
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # 📌 Статистика за сегодняшний день (из агрегатов user_daily_stats)
+            await cursor.execute("""
+                SELECT translated, avg_score, avg_minutes, missed,
+                    avg_score - avg_minutes * 2 - missed * 20 AS итоговый_балл
+                FROM (
+                    SELECT
+                        translated,
+                        COALESCE(score_sum::float / NULLIF(scored, 0), 0) AS avg_score,
+                        COALESCE(session_minutes / NULLIF(sessions, 0), 0) AS avg_minutes,
+                        GREATEST(0, assigned - translated) AS missed
+                    FROM user_daily_stats
+                    WHERE chat_id = %s AND user_id = %s AND date = CURRENT_DATE AND translated > 0
+                ) today;
+            """, (chat_id, user_id))
+
+            today_stats = await cursor.fetchone()
+
+            # 📌 Недельная статистика
+            await cursor.execute("""
+                SELECT user_id, translated, avg_score, avg_minutes, total_minutes, missed,
+                    avg_score - avg_minutes * 2 - missed * 20 AS итоговый_балл
+                FROM (
+                    SELECT
+                        user_id,
+                        SUM(translated) AS translated,
+                        COALESCE(SUM(score_sum)::float / NULLIF(SUM(scored), 0), 0) AS avg_score,
+                        COALESCE(SUM(session_minutes) / NULLIF(SUM(sessions), 0), 0) AS avg_minutes,
+                        SUM(session_minutes) AS total_minutes,
+                        GREATEST(0, SUM(assigned) - SUM(translated)) AS missed
+                    FROM user_daily_stats
+                    WHERE chat_id = %s AND user_id = %s AND date >= CURRENT_DATE - 6
+                    GROUP BY user_id
+                    HAVING SUM(translated) > 0
+                ) weekly;
+            """, (chat_id, user_id))
+
+            weekly_stats = await cursor.fetchone()
 
     # 📌 Формирование ответа
     if today_stats:
@@ -1116,6 +3144,7 @@ async def user_stats(update: Update, context: CallbackContext):
 import datetime
 import pytz
 
+@instrumented
 async def debug_timezone(update: Update, context: CallbackContext):
     now_utc = datetime.datetime.now(pytz.utc)
     await update.message.reply_text(
@@ -1125,7 +3154,6 @@ async def debug_timezone(update: Update, context: CallbackContext):
 
 from telegram import Update
 from telegram.ext import CommandHandler, CallbackContext
-import psycopg2
 import os
 
 # # Функция для сброса данных по ID
@@ -1148,45 +3176,52 @@ import os
 
 
 # === Функция для очистки данных пользователя ===
-def reset_user_data(user_id, date=None):
-    """Удаляет данные пользователя за указанный день (или за сегодня, если дата не указана)"""
-    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-    cursor = conn.cursor()
-
+async def reset_user_data(chat_id, user_id, date=None):
+    """Удаляет данные пользователя в группе за указанный день (или за сегодня, если дата не указана)"""
     # Если дата не указана, используем сегодняшнюю
     if date is None:
         date = datetime.date.today()
-    
-    # Удаляем переводы за указанную дату
-    cursor.execute("""
-        DELETE FROM translations 
-        WHERE user_id = %s AND timestamp::date = %s;
-    """, (user_id, date))
-
-    # Удаляем записи о прогрессе пользователя за указанную дату
-    cursor.execute("""
-        DELETE FROM user_progress 
-        WHERE user_id = %s AND start_time::date = %s;
-    """, (user_id, date))
-
-    # Удаляем предложения, выданные пользователю за указанную дату
-    cursor.execute("""
-        DELETE FROM daily_sentences 
-        WHERE user_id = %s AND date = %s;
-    """, (user_id, date))
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            # Удаляем переводы за указанную дату
+            await cursor.execute("""
+                DELETE FROM translations 
+                WHERE chat_id = %s AND user_id = %s AND timestamp >= %s AND timestamp < %s::date + 1;
+            """, (chat_id, user_id, date, date))
+
+            # Удаляем записи о прогрессе пользователя за указанную дату
+            await cursor.execute("""
+                DELETE FROM user_progress 
+                WHERE chat_id = %s AND user_id = %s AND start_time >= %s AND start_time < %s::date + 1;
+            """, (chat_id, user_id, date, date))
+
+            # Удаляем предложения, выданные пользователю за указанную дату
+            await cursor.execute("""
+                DELETE FROM daily_sentences 
+                WHERE chat_id = %s AND user_id = %s AND date = %s;
+            """, (chat_id, user_id, date))
+
+            # Сбрасываем счётчик номеров — новые задания снова начнутся с 1
+            await cursor.execute("""
+                DELETE FROM daily_sentence_counters
+                WHERE chat_id = %s AND user_id = %s AND date = %s;
+            """, (chat_id, user_id, date))
+
+            # Удаляем агрегаты статистики за указанную дату
+            await cursor.execute("""
+                DELETE FROM user_daily_stats
+                WHERE chat_id = %s AND user_id = %s AND date = %s;
+            """, (chat_id, user_id, date))
 
 # === Обработчик команды /resetme (для очистки данных) ===
+@instrumented
 async def reset_user_command(update: Update, context: CallbackContext):
     user = update.message.from_user
-    chat_id = update.message.chat_id
+    chat_id = await resolve_chat_id(update)
 
     # Проверяем, передан ли ID пользователя (для админа)
     if context.args:
-        ADMIN_ID = 117649764  # Заменить на свой Telegram ID
         if user.id != ADMIN_ID:
             await update.message.reply_text("❌ У вас нет прав на выполнение этой команды!")
             return
@@ -1213,7 +3248,7 @@ async def reset_user_command(update: Update, context: CallbackContext):
         date = None  # По умолчанию сбрасываем за сегодня
 
     # Выполняем сброс данных
-    reset_user_data(user_id, date)
+    await reset_user_data(chat_id, user_id, date)
     date_text = f"за {date}" if date else "за сегодня"
     await update.message.reply_text(f"✅ Данные пользователя {user_id} {date_text} сброшены!")
     print(f"✅ Данные пользователя {user_id} {date_text} сброшены!")
@@ -1223,9 +3258,224 @@ async def reset_user_command(update: Update, context: CallbackContext):
 
 
 
+@instrumented
+async def bot_stats(update: Update, context: CallbackContext):
+    """Служебная статистика бота (только для администратора)."""
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ У вас нет прав на выполнение этой команды!")
+        return
+
+    hits = grading_cache_stats["memory_hits"] + grading_cache_stats["db_hits"]
+    await update.message.reply_text(
+        "🗄 Кэш оценок GPT\n"
+        f"🔹 Попадания: {hits} (память: {grading_cache_stats['memory_hits']}, БД: {grading_cache_stats['db_hits']})\n"
+        f"🔹 Промахи: {grading_cache_stats['misses']}\n"
+        f"🔹 Доля попаданий: {grading_cache_hit_rate():.1%}\n"
+        f"🔹 Сохранено оценок: {grading_cache_stats['stores']}\n"
+        f"🔹 Записей в памяти: {len(grading_cache_memory)}\n\n"
+        f"🤖 OpenAI: circuit breaker {openai_breaker_state()}, сбоев подряд: {openai_breaker['failures']}\n\n"
+        "🧹 Предпроверка без GPT\n"
+        f"🔹 Пустые: {pregrader_stats['empty']}, по-русски: {pregrader_stats['wrong_language']}, "
+        f"слишком короткие: {pregrader_stats['too_short']}\n"
+        f"🔹 Совпали с эталоном: {pregrader_stats['reference_match']}, отправлено в GPT: {pregrader_stats['escalated']}\n\n"
+        "📤 Очередь отправки\n"
+        f"🔹 В очереди: {outbound_queue_depth()} (чатов: {len(outbound_workers)})\n"
+        f"🔹 Поставлено: {outbound_stats['queued']}, отправлено: {outbound_stats['sent']}, "
+        f"склеено: {outbound_stats['coalesced']}\n"
+        f"🔹 RetryAfter: {outbound_stats['retry_after']}, ошибок: {outbound_stats['failed']}\n"
+        f"🔹 Задержка p50/p95/max: {outbound_latency_percentile(50):.2f} / "
+        f"{outbound_latency_percentile(95):.2f} / {max(outbound_latencies, default=0):.2f} с"
+    )
+
+
+
+
+
+
+@instrumented
+async def rebuild_stats_command(update: Update, context: CallbackContext):
+    """Пересобирает user_daily_stats из сырых таблиц (только для администратора)."""
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ У вас нет прав на выполнение этой команды!")
+        return
+
+    rows = await rebuild_user_daily_stats()
+    await update.message.reply_text(f"✅ Статистика пересобрана: {rows} строк (пользователь × день).")
+
+
+
+
+
+
+GROUP_SETTINGS_FLAGS = {"active": "active", "morning": "morning_messages", "news": "news_enabled"}  # Аргумент -> колонка chat_groups
+GROUP_SETTINGS_USAGE = (
+    "📌 Формат: /groupsettings [reports 9,13,17|off] [morning on|off] [news on|off] [active on|off]\n"
+    "Часы указываются в часовом поясе бота."
+)
+
+
+@instrumented
+async def group_settings_command(update: Update, context: CallbackContext):
+    """Показывает и меняет расписание и настройки текущей группы (только для администратора)."""
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ У вас нет прав на выполнение этой команды!")
+        return
+
+    chat = update.effective_chat
+    if chat.type not in (chat.GROUP, chat.SUPERGROUP):
+        await update.message.reply_text("❌ Выполните эту команду в группе, настройки которой нужно изменить.")
+        return
+    await register_chat_group(chat)
+
+    args = [arg.lower() for arg in context.args]
+    if len(args) % 2:
+        await update.message.reply_text(GROUP_SETTINGS_USAGE)
+        return
+
+    changes = {}
+    for key, value in zip(args[::2], args[1::2]):
+        if key == "reports":
+            try:
+                hours = [] if value == "off" else sorted({int(hour) for hour in value.split(",")})
+            except ValueError:
+                hours = None
+            if hours is None or any(not 0 <= hour <= 23 for hour in hours):
+                await update.message.reply_text("❌ Ошибка: часы — числа от 0 до 23 через запятую.")
+                return
+            changes["report_hours"] = hours
+        elif key in GROUP_SETTINGS_FLAGS and value in ("on", "off"):
+            changes[GROUP_SETTINGS_FLAGS[key]] = value == "on"
+        else:
+            await update.message.reply_text(GROUP_SETTINGS_USAGE)
+            return
+
+    async with get_db_connection() as conn:
+        if changes:
+            # Имена колонок — только из GROUP_SETTINGS_FLAGS и report_hours, значения передаются параметрами
+            assignments = ", ".join(f"{column} = %s" for column in changes)
+            await conn.execute(f"UPDATE chat_groups SET {assignments} WHERE chat_id = %s;", (*changes.values(), chat.id))
+        cursor = await conn.execute(
+            "SELECT active, report_hours, morning_messages, news_enabled FROM chat_groups WHERE chat_id = %s;",
+            (chat.id,)
+        )
+        active, report_hours, morning_messages, news_enabled = await cursor.fetchone()
+
+    def on_off(flag):
+        return "вкл." if flag else "выкл."
+
+    await update.message.reply_text(
+        f"⚙️ Настройки группы {chat.title or chat.id}\n"
+        f"🔹 Рассылки: {on_off(active)}\n"
+        f"🔹 Промежуточные итоги: {', '.join(f'{hour}:00' for hour in report_hours) or 'выкл.'}\n"
+        f"🔹 Утренние напоминания: {on_off(morning_messages)}\n"
+        f"🔹 Новости: {on_off(news_enabled)}"
+    )
+
+
+@instrumented
+async def track_bot_membership(update: Update, context: CallbackContext):
+    """Бота добавили в группу или удалили из неё: включаем или выключаем для неё задачи по расписанию."""
+    member = update.my_chat_member
+    chat = member.chat
+    if chat.type not in (chat.GROUP, chat.SUPERGROUP):
+        return
+
+    active = member.new_chat_member.status not in (ChatMember.LEFT, ChatMember.BANNED)
+    async with get_db_connection() as conn:
+        await conn.execute("""
+            INSERT INTO chat_groups (chat_id, title, active) VALUES (%s, %s, %s)
+            ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, active = EXCLUDED.active;
+        """, (chat.id, chat.title, active))
+    known_chat_groups.add(chat.id)
+    logging.info(f"👥 Группа {chat.title} ({chat.id}): бот {'добавлен' if active else 'удалён'}.")
+
+
+
+
+
+
+# === Параллельная обработка обновлений ===
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно (не больше `max_workers` сразу),
+    обновления одного пользователя — строго по очереди, в порядке поступления.
+
+    Так долгий /translate одного пользователя не задерживает остальных, а его собственные
+    /letsgo, /done и /translate не гоняются друг с другом за user_progress и daily_sentences.
+
+    Сначала берётся блокировка пользователя, потом слот обработчика: ожидающие своей очереди
+    обновления того же пользователя не занимают слоты. Поэтому общий семафор базового класса
+    сделан заведомо большим, а лимит `max_workers` соблюдается своим семафором.
+    """
+
+    def __init__(self, max_workers):
+        super().__init__(max_concurrent_updates=max(max_workers, 1) * 1000)
+        self.max_workers = max_workers
+        self.workers = None  # Semaphore создаётся в initialize (внутри цикла событий)
+        self.user_locks = weakref.WeakValueDictionary()  # user_id -> Lock, пока его кто-то ждёт или держит
+
+    async def initialize(self):
+        self.workers = asyncio.Semaphore(self.max_workers)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+
+        if key is None:
+            async with self.workers:
+                await coroutine
+            return
+
+        lock = self.user_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.user_locks[key] = lock
+
+        async with lock:
+            async with self.workers:
+                await coroutine
+
+
+async def on_startup(app: Application):
+    """Выполняется один раз при старте Application: открываем пул и применяем миграции."""
+    start_metrics_server()
+    await init_db_pool()
+    await apply_migrations()
+    await maintain_partitions()
+    start_message_writer()
+    start_background_task(refill_sentence_pool())
+
+
+async def on_shutdown(app: Application):
+    """Выполняется при остановке Application: возвращаем все соединения и закрываем пул."""
+    await stop_message_writer()
+    await drain_outbound_queue()
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_news_http_client()
+    await close_openai_client()
+    await close_db_pool()
+
+
 def main():
     global application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))  
     application.add_handler(CommandHandler("newtasks", set_new_tasks))
@@ -1236,46 +3486,77 @@ def main():
     application.add_handler(CommandHandler("stats", user_stats))  
     application.add_handler(CommandHandler("time", debug_timezone))
     application.add_handler(CommandHandler("reset", reset_user_command))  
+    application.add_handler(CommandHandler("botstats", bot_stats))
+    application.add_handler(CommandHandler("rebuildstats", rebuild_stats_command))
+    application.add_handler(CommandHandler("groupsettings", group_settings_command))
+    application.add_handler(ChatMemberHandler(track_bot_membership, ChatMemberHandler.MY_CHAT_MEMBER))
 
     # 🔹 Логирование всех сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_message))  
 
-    scheduler = BackgroundScheduler()
+    # 🔹 Все задачи по расписанию выполняются в цикле событий бота через его JobQueue:
+    # без отдельных потоков, с учётом часового пояса BOT_TIMEZONE.
+    # Задачи для групп (per_group) обходят все активные группы параллельно, учитывая их настройки.
+    # Пропущенный запуск (бот был занят или перезапускался) выполняется, если опоздание не больше
+    # JOB_MISFIRE_GRACE_SECONDS; несколько пропущенных запусков сливаются в один,
+    # а новый запуск не стартует, пока не закончился предыдущий.
+    job_queue = application.job_queue
+    job_kwargs = {"misfire_grace_time": JOB_MISFIRE_GRACE_SECONDS, "coalesce": True, "max_instances": 1}
 
-    def run_async_job(async_func, context=None):
-        """Запускает асинхронную функцию внутри APScheduler."""
-        if context is None:
-            context = CallbackContext(application=application)
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(async_func(context))
+    def at(hour, minute):
+        return datetime.time(hour=hour, minute=minute, tzinfo=BOT_TIMEZONE)
 
     # ✅ Утренняя рассылка
-    scheduler.add_job(lambda: run_async_job(send_morning_reminder), "cron", hour=5, minute=1)
+    job_queue.run_daily(per_group(send_morning_reminder, "morning_messages"), at(5, 1), name="morning_reminder", job_kwargs=job_kwargs)
 
     # ✅ Утренние задания
-    scheduler.add_job(lambda: run_async_job(send_morning_tasks), "cron", hour=10, minute=1)
-    scheduler.add_job(lambda: run_async_job(send_morning_tasks), "cron", hour=14, minute=1)
-
-    # ✅ Промежуточные итоги
-    for hour in [9, 13, 17]:
-        scheduler.add_job(lambda: run_async_job(send_progress_report), "cron", hour=hour, minute=0)
+    job_queue.run_daily(per_group(send_morning_tasks, "morning_messages"), at(10, 1), name="morning_tasks_10", job_kwargs=job_kwargs)
+    job_queue.run_daily(per_group(send_morning_tasks, "morning_messages"), at(14, 1), name="morning_tasks_14", job_kwargs=job_kwargs)
+
+    # ✅ Промежуточные итоги: каждый час, для групп, у которых этот час есть в report_hours
+    for hour in range(24):
+        job_queue.run_daily(
+            per_group(send_progress_report, "%s = ANY(report_hours)", lambda hour=hour: (hour,)),
+            at(hour, 0), name=f"progress_report_{hour}", job_kwargs=job_kwargs
+        )
 
     # ✅ Итоги дня
-    scheduler.add_job(lambda: run_async_job(send_daily_summary), "cron", hour=22, minute=16)
+    job_queue.run_daily(per_group(send_daily_summary), at(22, 16), name="daily_summary", job_kwargs=job_kwargs)
 
-    # ✅ Итоги недели
-    scheduler.add_job(lambda: run_async_job(send_weekly_summary), "cron", day_of_week="sun", hour=22, minute=26)
+    # ✅ Итоги недели (days: 0 — воскресенье)
+    job_queue.run_daily(per_group(send_weekly_summary), at(22, 26), days=(0,), name="weekly_summary", job_kwargs=job_kwargs)
 
     # ✅ Автозавершение сессий в 23:59
-    scheduler.add_job(lambda: run_async_job(force_finalize_sessions), "cron", hour=23, minute=59)
-    
-    scheduler.add_job(lambda: run_async_job(send_german_news, CallbackContext(application=application)), "cron", hour=5, minute=30)
+    job_queue.run_daily(per_group(force_finalize_sessions), at(23, 59), name="force_finalize_sessions", job_kwargs=job_kwargs)
+
+    job_queue.run_daily(per_group(send_german_news, "news_enabled"), at(5, 30), name="german_news", job_kwargs=job_kwargs)
+
+    # ✅ Пополнение пула предложений
+    job_queue.run_repeating(
+        refill_sentence_pool, interval=SENTENCE_POOL_REFILL_MINUTES * 60,
+        first=SENTENCE_POOL_REFILL_MINUTES * 60, name="refill_sentence_pool", job_kwargs=job_kwargs
+    )
 
-    scheduler.start()
-    print("🚀 Бот запущен! Ожидаем сообщения...")
-    application.run_polling()
+    # ✅ Очистка кэша оценок (TTL и ограничение размера)
+    job_queue.run_daily(purge_grading_cache, at(3, 30), name="purge_grading_cache", job_kwargs=job_kwargs)
+
+    # ✅ Партиции messages и translations: новые месяцы заранее, старые — по сроку хранения
+    job_queue.run_daily(maintain_partitions, at(3, 40), name="maintain_partitions", job_kwargs=job_kwargs)
+
+    if BOT_MODE == "webhook":
+        # 🔹 Встроенный HTTP-сервер принимает обновления от Telegram; запросы без верного
+        # секретного токена отклоняются, а сам webhook регистрируется при старте
+        print(f"🚀 Бот запущен в режиме webhook: {WEBHOOK_URL}/{WEBHOOK_PATH} (порт {WEBHOOK_PORT})")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+        )
+    else:
+        print("🚀 Бот запущен! Ожидаем сообщения...")
+        application.run_polling()
 
 import sys
 # ✅ Вызов main() для запуска бота